@@ -0,0 +1,542 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import aiofiles
+
+from bus import CHAT_TOPIC, SYSTEM_TOPIC, MessageBus
+from chat_functions import supervise
+from chat_message import ChatMessage
+from chat_prototype import READ_ENGINES, Heartbeat, read_msgs, read_with_watchdog, save_messages, send_msgs_with_ping
+from fake_server import StandInServer
+from history import HISTORY_BACKENDS, open_history
+from outbox import Outbox
+from queues import queue_from_env
+from token_store import save_token_store
+
+
+logger = logging.getLogger('benchmark')
+
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+STARTUP_MODULES = ('chat_prototype', 'chat_reader', 'registration', 'gui')
+STARTUP_BUDGETS_MS = {
+    'import': 300,
+    'first_message': 1500,
+    'first_window': 3000,
+}
+
+
+async def save_messages_per_line(history_file, save_queue):
+    while True:
+        message = await save_queue.get()
+        timestamp = message.timestamp.strftime("[%d.%m.%y %H:%M]")
+        async with aiofiles.open(history_file, mode='a', encoding='utf-8') as f:
+            await f.write(f"{timestamp} {message.line}\n")
+            await f.flush()
+        save_queue.task_done()
+
+
+def history_writer(backend, durability):
+    def writer(history_file, save_queue):
+        return save_messages(open_history(backend, history_file, durability), save_queue)
+    return writer
+
+
+async def measure_writer(writer, lines, line_size):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        history_file = os.path.join(tmp_dir, 'chat_history')
+        save_queue = asyncio.Queue()
+        save_task = asyncio.create_task(writer(history_file, save_queue))
+        text = 'x' * line_size
+
+        started_at = time.perf_counter()
+        for _ in range(lines):
+            await save_queue.put(ChatMessage(text=text))
+            await asyncio.sleep(0)
+        await save_queue.join()
+        elapsed = time.perf_counter() - started_at
+
+        save_task.cancel()
+        await asyncio.gather(save_task, return_exceptions=True)
+    return lines / elapsed
+
+
+async def bench_save_messages(args):
+    writers = {
+        'per-line': save_messages_per_line,
+    }
+    for backend in HISTORY_BACKENDS:
+        for durability in ('buffered', 'flush', 'fsync'):
+            writers[f'{backend}-{durability}'] = history_writer(backend, durability)
+    for name, writer in writers.items():
+        rate = await measure_writer(writer, args.lines, args.line_size)
+        print(f"save_messages[{name}]: {rate:,.0f} строк/с")
+
+
+async def measure_tk(idle_interval, duration, keystrokes):
+    import tkinter as tk
+    from gui import TkActivity, update_tk
+    root = tk.Tk()
+    entry = tk.Entry(root)
+    entry.pack()
+    activity = TkActivity()
+    activity.watch_input(root)
+
+    sent_at = []
+    latencies = []
+    entry.bind('<Key>', lambda event: latencies.append(time.perf_counter() - sent_at[-1]), add='+')
+    tk_task = asyncio.create_task(update_tk(root, activity, 1 / 120, idle_interval))
+    try:
+        await asyncio.sleep(2)
+        cpu_started_at = time.process_time()
+        await asyncio.sleep(duration)
+        idle_cpu = (time.process_time() - cpu_started_at) / duration
+
+        for _ in range(keystrokes):
+            await asyncio.sleep(1.5)
+            sent_at.append(time.perf_counter())
+            entry.event_generate('<Key-a>', when='tail')
+        await asyncio.sleep(1)
+    finally:
+        tk_task.cancel()
+        await asyncio.gather(tk_task, return_exceptions=True)
+        root.destroy()
+    return idle_cpu, latencies
+
+
+async def bench_tk(args):
+    # tkinter и gui нужны только бенчмаркам окна, остальные запускаются и без них
+    import tkinter as tk
+    for name, idle_interval in (('120 Гц', 1 / 120), ('adaptive 20 Гц', 1 / 20), ('adaptive 10 Гц', 1 / 10)):
+        try:
+            idle_cpu, latencies = await measure_tk(idle_interval, args.duration, args.keystrokes)
+        except tk.TclError as e:
+            print(f"update_tk: нет дисплея для Tk ({e})")
+            return
+        latencies_ms = [latency * 1000 for latency in latencies] or [float('nan')]
+        print(
+            f"update_tk[{name}]: CPU в простое {idle_cpu:.2%}, "
+            f"задержка ввода ср. {sum(latencies_ms) / len(latencies_ms):.1f} мс, макс. {max(latencies_ms):.1f} мс"
+        )
+
+
+def max_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def flood_latency(message):
+    parts = message.split(' ', 2)
+    if len(parts) < 3 or not parts[0].isdigit():
+        return None
+    return time.perf_counter() - float(parts[1])
+
+
+def format_latencies(latencies):
+    if not latencies:
+        return 'нет данных'
+    latencies = sorted(latencies)
+    median = latencies[len(latencies) // 2] * 1000
+    p99 = latencies[int(len(latencies) * 0.99)] * 1000
+    return f"медиана {median:.1f} мс, p99 {p99:.1f} мс"
+
+
+def reader_bus(messages_queue, save_queue):
+    bus = MessageBus()
+    bus.subscribe(messages_queue, CHAT_TOPIC)
+    bus.subscribe(save_queue, CHAT_TOPIC, SYSTEM_TOPIC)
+    return bus
+
+
+async def discard_queue(queue):
+    while True:
+        await queue.get()
+        queue.task_done()
+
+
+async def collect_flood(messages_queue, expected, latencies):
+    received = 0
+    while received < expected:
+        latency = flood_latency((await messages_queue.get()).text)
+        if latency is not None:
+            latencies.append(latency)
+            received += 1
+
+
+async def measure_sender(messages_count, line_size, max_batch):
+    server = await StandInServer().start()
+    account_hash = server.add_account('benchmark')
+    listen_reader, listen_writer = await asyncio.open_connection(server.host, server.listen_port)
+    await server.wait_for_listeners()
+
+    sending_queue = asyncio.Queue()
+    save_queue = asyncio.Queue()
+    for number in range(messages_count):
+        sending_queue.put_nowait(f'{number} ' + 'x' * line_size)
+
+    started_at = time.perf_counter()
+    sender = asyncio.create_task(send_msgs_with_ping(
+        server.host, server.send_port, account_hash, sending_queue, save_queue, asyncio.Queue(), Heartbeat(),
+        max_batch=max_batch,
+    ))
+    numbers = []
+    while len(numbers) < messages_count:
+        line = await listen_reader.readline()
+        numbers.append(int(line.decode().split(': ', 1)[1].split(' ', 1)[0]))
+    elapsed = time.perf_counter() - started_at
+
+    sender.cancel()
+    await asyncio.gather(sender, return_exceptions=True)
+    listen_writer.close()
+    await server.stop()
+    return messages_count / elapsed, numbers == sorted(numbers)
+
+
+def write_journal(journal_file, messages_count, acked_count):
+    # журнал после падения: часть сообщений подтверждена посередине, остальные ждут отправки
+    records = [{'id': number, 'message': f'{number} outbox'} for number in range(1, messages_count + 1)]
+    records.insert(acked_count, {'ack': acked_count})
+    with open(journal_file, 'w', encoding='utf-8') as f:
+        f.writelines(json.dumps(record) + '\n' for record in records)
+
+
+async def measure_outbox_replay(tmp_dir, messages_count):
+    journal_file = os.path.join(tmp_dir, 'outbox.jsonl')
+    acked_count = messages_count // 3
+    write_journal(journal_file, messages_count, acked_count)
+    outbox = Outbox(journal_file).load()
+    expected = list(range(acked_count + 1, messages_count + 1))
+
+    server = await StandInServer().start()
+    account_hash = server.add_account('benchmark')
+    listen_reader, listen_writer = await asyncio.open_connection(server.host, server.listen_port)
+    await server.wait_for_listeners()
+    sender = asyncio.create_task(send_msgs_with_ping(
+        server.host, server.send_port, account_hash, asyncio.Queue(), asyncio.Queue(), asyncio.Queue(), Heartbeat(),
+        outbox=outbox,
+    ))
+    numbers = []
+    while len(numbers) < len(expected):
+        line = await asyncio.wait_for(listen_reader.readline(), 5)
+        numbers.append(int(line.decode().split(': ', 1)[1].split(' ', 1)[0]))
+    # при нарушенном порядке подтверждения не очищают журнал, поэтому ждём не бесконечно
+    for _ in range(500):
+        if not outbox.pending:
+            break
+        await asyncio.sleep(0.01)
+
+    sender.cancel()
+    await asyncio.gather(sender, return_exceptions=True)
+    listen_writer.close()
+    await server.stop()
+    return numbers == expected and not outbox.pending and os.path.getsize(journal_file) == 0
+
+
+async def bench_sender(args):
+    ordered_everywhere = True
+    for name, max_batch in (('по одному', 1), ('пачками', 100)):
+        rate, ordered = await measure_sender(args.lines, args.line_size, max_batch)
+        ordered_everywhere &= ordered
+        print(f"send_msgs_with_ping[{name}]: {rate:,.0f} сообщений/с, порядок {'сохранён' if ordered else 'НАРУШЕН'}")
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        replayed = await measure_outbox_replay(tmp_dir, 300)
+    ordered_everywhere &= replayed
+    print(f"досылка из журнала отправки: {'в исходном порядке' if replayed else 'НАРУШЕНА'}")
+    return ordered_everywhere
+
+
+async def measure_reader(read_engine, args):
+    server = await StandInServer().start()
+    messages_queue = queue_from_env('messages', 10000, 'drop_oldest')
+    save_queue = queue_from_env('save', 10000, 'block')
+    bus = reader_bus(messages_queue, save_queue)
+    rss_before = max_rss_mb()
+    reader = asyncio.create_task(read_engine(server.host, server.listen_port, bus, asyncio.Queue(), Heartbeat()))
+    saver = asyncio.create_task(discard_queue(save_queue))
+    await server.wait_for_listeners()
+
+    latencies = []
+    started_at = time.perf_counter()
+    flood = asyncio.create_task(server.flood(args.lines, args.rate, args.line_size))
+    await collect_flood(messages_queue, args.lines, latencies)
+    elapsed = time.perf_counter() - started_at
+
+    for task in (flood, reader, saver):
+        task.cancel()
+    await asyncio.gather(flood, reader, saver, return_exceptions=True)
+    await server.stop()
+    return args.lines / elapsed, latencies, max_rss_mb() - rss_before
+
+
+async def bench_reader(args):
+    for name, read_engine in READ_ENGINES.items():
+        rate, latencies, rss_growth = await measure_reader(read_engine, args)
+        print(
+            f"{read_engine.__name__}[{name}]: {rate:,.0f} сообщений/с, задержка {format_latencies(latencies)}, "
+            f"рост памяти {rss_growth:.1f} МБ"
+        )
+
+
+async def bench_reconnect(args):
+    server = await StandInServer().start()
+    messages_queue = asyncio.Queue()
+    save_queue = asyncio.Queue()
+    # каждый разрыв - неудача для supervise; без паузы и без размыкания автомата замер показывает
+    # только время от разрыва до первого сообщения по новому соединению
+    reader = asyncio.create_task(supervise(
+        read_with_watchdog, server.host, server.listen_port, reader_bus(messages_queue, save_queue), asyncio.Queue(),
+        Heartbeat(), 300, name='benchmark', initial_delay=0, jitter=0, max_failures=args.reconnects + 1, cooldown=0,
+    ))
+    saver = asyncio.create_task(discard_queue(save_queue))
+    await server.wait_for_listeners()
+
+    reconnect_times = []
+    for _ in range(args.reconnects):
+        server.drop_listeners()
+        dropped_at = time.perf_counter()
+        await server.wait_for_listeners()
+        server.broadcast(f"0 {time.perf_counter():.9f} reconnected")
+        await collect_flood(messages_queue, 1, [])
+        reconnect_times.append(time.perf_counter() - dropped_at)
+
+    reader.cancel()
+    saver.cancel()
+    await asyncio.gather(reader, saver, return_exceptions=True)
+    await server.stop()
+    print(f"переподключение чтения: {format_latencies(reconnect_times)} (без паузы между попытками)")
+
+
+async def bench_pipeline(args):
+    import tkinter as tk
+    from tkinter.scrolledtext import ScrolledText
+    from gui import update_conversation_history, update_tk
+    try:
+        root = tk.Tk()
+    except tk.TclError as e:
+        print(f"конвейер GUI: нет дисплея для Tk ({e})")
+        return
+    panel = ScrolledText(root, wrap='none')
+    panel.pack()
+    render_latencies = []
+    insert = panel.insert
+
+    def timed_insert(index, text):
+        for line in text.splitlines():
+            latency = flood_latency(line)
+            if latency is not None:
+                render_latencies.append(latency)
+        insert(index, text)
+
+    panel.insert = timed_insert
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        server = await StandInServer().start()
+        messages_queue = queue_from_env('messages', 10000, 'drop_oldest')
+        save_queue = queue_from_env('save', 10000, 'block')
+        history = open_history('text', os.path.join(tmp_dir, 'chat_history.txt'))
+        rss_before = max_rss_mb()
+        tasks = [
+            asyncio.create_task(update_tk(root)),
+            asyncio.create_task(update_conversation_history(panel, messages_queue)),
+            asyncio.create_task(save_messages(history, save_queue)),
+            asyncio.create_task(read_msgs(
+                server.host, server.listen_port, reader_bus(messages_queue, save_queue), asyncio.Queue(), Heartbeat(),
+            )),
+        ]
+        await server.wait_for_listeners()
+
+        started_at = time.perf_counter()
+        await server.flood(args.lines, args.rate, args.line_size)
+        while len(render_latencies) < args.lines and time.perf_counter() - started_at < 60:
+            await asyncio.sleep(0.01)
+        elapsed = time.perf_counter() - started_at
+
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await server.stop()
+    root.destroy()
+    print(
+        f"конвейер чтение -> окно + история: {len(render_latencies) / elapsed:,.0f} сообщений/с, "
+        f"задержка до отрисовки {format_latencies(render_latencies)}, рост памяти {max_rss_mb() - rss_before:.1f} МБ"
+    )
+
+
+def import_time(module):
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        capture_output=True, text=True, check=True, cwd=PROJECT_DIR,
+    )
+    imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        _, cumulative_us, name = line[len('import time:'):].split('|')
+        imports.append((int(cumulative_us) / 1000, name.rstrip()))
+    total_ms = imports[-1][0]
+    # прямые зависимости модуля идут с отступом на уровень глубже его самого
+    direct_imports = [(ms, name.strip()) for ms, name in imports if len(name) - len(name.lstrip()) == 3]
+    return total_ms, sorted(direct_imports, reverse=True)[:3]
+
+
+def check_budget(name, elapsed_ms, budget_ms):
+    within_budget = elapsed_ms <= budget_ms
+    mark = '' if within_budget else ' ⚠️ бюджет превышен'
+    print(f"{name}: {elapsed_ms:.0f} мс (бюджет {budget_ms} мс){mark}")
+    return within_budget
+
+
+async def spawn_client(script, tmp_dir, server, *args, **env):
+    env = dict(
+        os.environ, CHAT_HOST=server.host, LISTEN_CHAT_PORT=str(server.listen_port),
+        MESSAGE_CHAT_PORT=str(server.send_port), CHAT_HISTORY=os.path.join(tmp_dir, 'chat_history.txt'),
+        CHAT_OUTBOX=os.path.join(tmp_dir, 'chat_outbox.jsonl'), **env,
+    )
+    return await asyncio.create_subprocess_exec(
+        sys.executable, os.path.join(PROJECT_DIR, script), *args, env=env, cwd=tmp_dir,
+        stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+    )
+
+
+async def stop_client(process):
+    if process.returncode is None:
+        process.terminate()
+    await process.wait()
+
+
+async def measure_first_message(tmp_dir):
+    server = await StandInServer().start()
+    started_at = time.perf_counter()
+    process = await spawn_client('chat_reader.py', tmp_dir, server, '--output', 'text')
+    try:
+        await server.wait_for_listeners()
+        server.broadcast('first message')
+        await process.stdout.readline()
+        return time.perf_counter() - started_at
+    finally:
+        await stop_client(process)
+        await server.stop()
+
+
+async def measure_first_window(tmp_dir):
+    server = await StandInServer().start()
+    account_hash = server.add_account('benchmark')
+    started_at = time.perf_counter()
+    process = await spawn_client('chat_prototype.py', tmp_dir, server, CHAT_HASH=account_hash)
+    try:
+        while line := await process.stderr.readline():
+            if 'Окно чата открыто' in line.decode():
+                return time.perf_counter() - started_at
+        return None
+    finally:
+        await stop_client(process)
+        await server.stop()
+
+
+def process_rss_mb(pid):
+    with open(f'/proc/{pid}/status', encoding='utf-8') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+async def measure_accounts(tmp_dir, accounts_count):
+    server = await StandInServer().start()
+    accounts = [
+        {'nickname': f'bot{number}', 'account_hash': server.add_account(f'bot{number}')}
+        for number in range(accounts_count)
+    ]
+    accounts_file = os.path.join(tmp_dir, f'chat_accounts_{accounts_count}.json')
+    save_token_store(accounts_file, accounts)
+    process = await spawn_client('multi_account.py', tmp_dir, server, '--accounts', accounts_file)
+    try:
+        await server.wait_for_listeners()
+        while len(server.handlers) < accounts_count + 1:
+            await asyncio.sleep(0.05)
+        await asyncio.sleep(1)
+        return process_rss_mb(process.pid)
+    finally:
+        await stop_client(process)
+        await server.stop()
+
+
+async def bench_accounts(args):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        single_rss = await measure_accounts(tmp_dir, 1)
+        rss = await measure_accounts(tmp_dir, args.accounts)
+    print(
+        f"multi_account[{args.accounts} аккаунтов]: {rss:.1f} МБ в одном процессе "
+        f"против ~{single_rss * args.accounts:.1f} МБ в {args.accounts} отдельных ({single_rss:.1f} МБ на процесс)"
+    )
+
+
+async def bench_startup(args):
+    within_budget = True
+    for module in STARTUP_MODULES:
+        total_ms, direct_imports = import_time(module)
+        within_budget &= check_budget(f"import {module}", total_ms, STARTUP_BUDGETS_MS['import'])
+        print('    самые тяжёлые: ' + ', '.join(f"{name} {ms:.0f} мс" for ms, name in direct_imports))
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        elapsed = await measure_first_message(tmp_dir)
+        within_budget &= check_budget(
+            'chat_reader.py: первое сообщение', elapsed * 1000, STARTUP_BUDGETS_MS['first_message'],
+        )
+
+    if not os.environ.get('DISPLAY'):
+        print("chat_prototype.py: первое окно - нет дисплея для Tk")
+        return within_budget
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        elapsed = await measure_first_window(tmp_dir)
+    if elapsed is None:
+        print("chat_prototype.py: первое окно - клиент завершился, не открыв окно")
+        return False
+    within_budget &= check_budget('chat_prototype.py: первое окно', elapsed * 1000, STARTUP_BUDGETS_MS['first_window'])
+    return within_budget
+
+
+BENCHMARKS = {
+    'save': bench_save_messages,
+    'send': bench_sender,
+    'read': bench_reader,
+    'reconnect': bench_reconnect,
+    'pipeline': bench_pipeline,
+    'tk': bench_tk,
+    'startup': bench_startup,
+    'accounts': bench_accounts,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Бенчмарки клиента чата')
+    parser.add_argument('benchmarks', nargs='*', help=f"из {', '.join(BENCHMARKS)}; по умолчанию все")
+    parser.add_argument('--lines', type=int, default=20000)
+    parser.add_argument('--line-size', type=int, default=80)
+    parser.add_argument('--duration', type=float, default=5, help='длительность замера простоя, секунд')
+    parser.add_argument('--keystrokes', type=int, default=5)
+    parser.add_argument('--rate', type=float, help='сообщений в секунду от тестового сервера, по умолчанию без ограничения')
+    parser.add_argument('--reconnects', type=int, default=5)
+    parser.add_argument('--accounts', type=int, default=50, help='число аккаунтов для бенчмарка accounts')
+    args = parser.parse_args()
+    unknown = set(args.benchmarks) - set(BENCHMARKS)
+    if unknown:
+        parser.error(f"неизвестные бенчмарки: {', '.join(sorted(unknown))}")
+
+    logging.getLogger('chat_prototype').setLevel(logging.WARNING)
+    logging.getLogger('chat_functions').setLevel(logging.WARNING)
+    logging.getLogger('fake_server').setLevel(logging.WARNING)
+    over_budget = [name for name in args.benchmarks or BENCHMARKS if asyncio.run(BENCHMARKS[name](args)) is False]
+    if over_budget:
+        sys.exit(f"проверки не пройдены: {', '.join(over_budget)}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,27 @@
+CHAT_TOPIC = 'chat'
+SYSTEM_TOPIC = 'system'
+
+
+class MessageBus:
+    def __init__(self):
+        self.subscribers = {}
+
+    def subscribe(self, queue, *topics):
+        for topic in topics:
+            # список подписчиков заменяем целиком, чтобы publish мог обходить его без копии
+            self.subscribers[topic] = [*self.subscribers.get(topic, ()), queue]
+        return queue
+
+    def unsubscribe(self, queue, *topics):
+        for topic in topics or list(self.subscribers):
+            self.subscribers[topic] = [
+                subscriber for subscriber in self.subscribers.get(topic, ()) if subscriber is not queue
+            ]
+
+    async def publish(self, topic, message):
+        for queue in self.subscribers.get(topic, ()):
+            if queue.full():
+                # ждёт только очередь с политикой block, остальные решают сами, что выбросить
+                await queue.put(message)
+            else:
+                queue.put_nowait(message)
@@ -0,0 +1,86 @@
+import logging
+import os
+import struct
+import time
+
+
+logger = logging.getLogger('capture')
+
+MAGIC = b'CHATCAP2'
+# время от начала записи (с), канал, номер соединения, длина данных; по номеру соединения
+# разделяются аккаунты multi_account.py и переподключения
+RECORD_HEADER = struct.Struct('<dBII')
+
+READ = 0
+SENT = 1
+SEND_REPLY = 2
+CHANNEL_NAMES = {READ: 'read', SENT: 'sent', SEND_REPLY: 'reply'}
+
+
+class Recorder:
+    enabled = True
+
+    def __init__(self, capture_file):
+        self.capture_file = capture_file
+        self.file = open(capture_file, 'wb')
+        self.file.write(MAGIC)
+        self.started_at = time.monotonic()
+        self.connections = 0
+        logger.info(f"⏺️ Трафик чата записывается в {capture_file}")
+
+    def new_connection(self):
+        self.connections += 1
+        return self.connections
+
+    def record(self, channel, data, connection_id=0):
+        # обычная буферизованная запись: на каждую строку не стоит гонять поток, как делает aiofiles
+        self.file.write(RECORD_HEADER.pack(time.monotonic() - self.started_at, channel, connection_id, len(data)))
+        self.file.write(data)
+
+    def close(self):
+        self.file.close()
+
+
+class NullRecorder:
+    enabled = False
+
+    def new_connection(self):
+        return 0
+
+    def record(self, channel, data, connection_id=0):
+        pass
+
+    def close(self):
+        pass
+
+
+recorder = NullRecorder()
+
+
+def enable_from_env():
+    global recorder
+    capture_file = os.environ.get('CHAT_CAPTURE')
+    if capture_file and not recorder.enabled:
+        recorder = Recorder(capture_file)
+    return recorder.enabled
+
+
+def close():
+    global recorder
+    recorder.close()
+    recorder = NullRecorder()
+
+
+def read_capture(capture_file):
+    with open(capture_file, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{capture_file} - не файл записи трафика чата")
+        while header := f.read(RECORD_HEADER.size):
+            if len(header) < RECORD_HEADER.size:
+                # запись оборвалась при аварийном завершении
+                return
+            offset, channel, connection_id, size = RECORD_HEADER.unpack(header)
+            data = f.read(size)
+            if len(data) < size:
+                return
+            yield offset, channel, connection_id, data
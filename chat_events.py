@@ -0,0 +1,45 @@
+from enum import Enum
+
+
+class TkAppClosed(Exception):
+    pass
+
+
+class ReadConnectionStateChanged(Enum):
+    INITIATED = 'устанавливаем соединение'
+    ESTABLISHED = 'соединение установлено'
+    CLOSED = 'соединение закрыто'
+
+    def __str__(self):
+        return str(self.value)
+
+
+class SendingConnectionStateChanged(Enum):
+    INITIATED = 'устанавливаем соединение'
+    ESTABLISHED = 'соединение установлено'
+    CLOSED = 'соединение закрыто'
+
+    def __str__(self):
+        return str(self.value)
+
+
+class NicknameReceived:
+    def __init__(self, nickname):
+        self.nickname = nickname
+
+
+class CircuitStateChanged:
+    def __init__(self, channel, state):
+        self.channel = channel
+        self.state = state
+
+
+class RoundTripMeasured:
+    def __init__(self, rtt, jitter, timeout):
+        self.rtt = rtt
+        self.jitter = jitter
+        self.timeout = timeout
+
+
+def status_update_key(update):
+    return type(update), getattr(update, 'channel', None)
@@ -1,9 +1,19 @@
 import asyncio
+import contextvars
+import functools
 import json
 import logging
+import random
+import socket
+import time
 from asyncio import StreamWriter, StreamReader
+from enum import Enum
 from typing import Dict
 
+from exceptiongroup import BaseExceptionGroup
+
+import metrics
+
 
 logger = logging.getLogger('chat_functions')
 
@@ -38,29 +48,124 @@ async def authorise(reader: StreamReader, writer: StreamWriter, account_hash: st
         raise
 
 
+async def register(reader: StreamReader, writer: StreamWriter, nickname: str) -> Dict:
+    await reader.readline()
+    writer.write(b'\n')
+    await writer.drain()
+    await reader.readline()
+    writer.write((nickname + '\n').encode())
+    await writer.drain()
+    account_data = await reader.readline()
+    return json.loads(account_data.decode().strip())
+
+
 async def open_connection(host: str, port: int):
     reader, writer = await asyncio.open_connection(host, port)
     return reader, writer
 
 
-def reconnect(max_retries=10, initial_delay=1, max_delay=60):
+class CircuitState(Enum):
+    CLOSED = 'замкнут'
+    OPEN = 'разомкнут, ждём перед новой попыткой'
+    HALF_OPEN = 'пробное подключение'
+
+    def __str__(self):
+        return str(self.value)
+
+
+RECONNECT_ERRORS = (ConnectionError, socket.gaierror, OSError, asyncio.TimeoutError)
+
+# supervise кладёт сюда, что вызвать после подключения; задачи обработчика получают его вместе с контекстом
+on_connected = contextvars.ContextVar('on_connected', default=None)
+
+
+def connected():
+    callback = on_connected.get()
+    if callback:
+        callback()
+
+
+def find_connection_error(error):
+    if isinstance(error, RECONNECT_ERRORS):
+        return error
+    if isinstance(error, BaseExceptionGroup):
+        connection_errors, other_errors = error.split(RECONNECT_ERRORS)
+        if connection_errors and not other_errors:
+            return find_connection_error(connection_errors.exceptions[0])
+    return None
+
+
+async def supervise(func, *args, name='соединение', on_state_change=None, max_failures=5, initial_delay=1,
+                    max_delay=60, jitter=0.5, stable_period=30, cooldown=120, **kwargs):
+    failures = 0
+    delay = initial_delay
+    state = CircuitState.CLOSED
+    attempts_counter = metrics.registry.counter('chat_reconnect_attempts', channel=name)
+    open_counter = metrics.registry.counter('chat_circuit_opened', channel=name)
+    duration_summary = metrics.registry.summary('chat_reconnect_duration_seconds', channel=name)
+    failed_at = None
+
+    async def set_state(new_state):
+        nonlocal state
+        if new_state != state:
+            state = new_state
+            logger.info(f"⚡ {name}: автомат переподключения {state}")
+            if on_state_change:
+                await on_state_change(state)
+
+    async def mark_stable():
+        nonlocal failures, delay
+        await asyncio.sleep(stable_period)
+        failures = 0
+        delay = initial_delay
+        await set_state(CircuitState.CLOSED)
+
+    def mark_connected():
+        # длительность переподключения - от ошибки до следующего успешного подключения, с паузами и попытками
+        nonlocal failed_at
+        if failed_at is not None:
+            duration_summary.observe(time.monotonic() - failed_at)
+            failed_at = None
+
+    context_token = on_connected.set(mark_connected)
+    try:
+        while True:
+            stable_task = asyncio.create_task(mark_stable())
+            try:
+                return await func(*args, **kwargs)
+            except Exception as error:
+                e = find_connection_error(error)
+                if e is None:
+                    logger.error(f"❌ {name}: неожиданная ошибка: {error}")
+                    raise
+                if failed_at is None:
+                    failed_at = time.monotonic()
+                failures += 1
+                attempts_counter.inc()
+                if failures >= max_failures:
+                    open_counter.inc()
+                    await set_state(CircuitState.OPEN)
+                    logger.error(f"❌ {name}: {failures} неудачных попыток подряд, пауза {cooldown}с: {e}")
+                    await asyncio.sleep(cooldown)
+                    await set_state(CircuitState.HALF_OPEN)
+                    continue
+                pause = delay * (1 - jitter * random.random())
+                logger.warning(f"🔄 {name}: попытка переподключения {failures}/{max_failures} через {pause:.1f}с: {e}")
+                await asyncio.sleep(pause)
+                delay = min(delay * 2, max_delay)
+            finally:
+                stable_task.cancel()
+    finally:
+        on_connected.reset(context_token)
+
+
+def reconnect(max_retries=10, initial_delay=1, max_delay=60, jitter=0.5, stable_period=30, cooldown=120):
     def decorator(func):
+        @functools.wraps(func)
         async def wrapper(*args, **kwargs):
-            retry_count = 0
-            delay = initial_delay
-            while retry_count < max_retries:
-                try:
-                    return await func(*args, **kwargs)
-                except (ConnectionError, socket.gaierror, OSError, asyncio.TimeoutError) as e:
-                    retry_count += 1
-                    if retry_count >= max_retries:
-                        logger.error(f"❌ Превышено максимальное количество попыток переподключения: {max_retries}")
-                        raise
-                    logger.warning(f"🔄 Попытка переподключения {retry_count}/{max_retries} через {delay}с: {e}")
-                    await asyncio.sleep(delay)
-                    delay = min(delay * 2, max_delay)
-                except Exception as e:
-                    logger.error(f"❌ Неожиданная ошибка: {e}")
-                    raise
+            return await supervise(
+                func, *args, name=func.__name__, max_failures=max_retries, initial_delay=initial_delay,
+                max_delay=max_delay, jitter=jitter, stable_period=stable_period, cooldown=cooldown, **kwargs,
+            )
         return wrapper
-    return decorator
\ No newline at end of file
+    return decorator
@@ -0,0 +1,89 @@
+import datetime
+import time
+
+
+INCOMING = 'incoming'
+OUTGOING = 'outgoing'
+SYSTEM = 'system'
+
+OUTGOING_PREFIX = '> '
+# в истории направление записано явно; строки с сервера хранятся без пробелов по краям,
+# поэтому метку с ведущим пробелом не спутать с текстом входящего сообщения
+HISTORY_MARKERS = {OUTGOING: f' {OUTGOING_PREFIX}', SYSTEM: ' * '}
+
+
+class ChatMessage:
+    # один объект на сообщение для окна, истории и поиска; текст и автор разбираются при первом обращении
+    __slots__ = ('raw', 'direction', 'received_at', 'received_monotonic', '_text', '_author',
+                 'history_position')
+
+    def __init__(self, raw=None, direction=INCOMING, text=None, received_at=None, received_monotonic=None):
+        self.raw = raw
+        self.direction = direction
+        self.received_at = time.time() if received_at is None else received_at
+        self.received_monotonic = time.monotonic() if received_monotonic is None else received_monotonic
+        self._text = text
+        self._author = None
+        # смещение или id строки в истории, известно после того, как она записана на диск
+        self.history_position = None
+
+    @classmethod
+    def outgoing(cls, text):
+        return cls(direction=OUTGOING, text=text)
+
+    @classmethod
+    def system(cls, text):
+        return cls(direction=SYSTEM, text=text)
+
+    @classmethod
+    def stored(cls, direction, text, received_at):
+        # у сохранённого сообщения время может быть неизвестно, текущее вместо него не подставляем
+        message = cls(direction=direction, text=text)
+        message.received_at = received_at
+        return message
+
+    @classmethod
+    def from_history(cls, timestamp, line, position=None):
+        received_at = timestamp.timestamp() if timestamp else None
+        for direction, marker in HISTORY_MARKERS.items():
+            if line.startswith(marker):
+                message = cls.stored(direction, line[len(marker):], received_at)
+                break
+        else:
+            message = cls.stored(INCOMING, line, received_at)
+        message.history_position = position
+        return message
+
+    @property
+    def text(self):
+        if self._text is None:
+            self._text = self.raw.decode('utf-8', errors='replace').strip()
+        return self._text
+
+    @property
+    def author(self):
+        if self._author is None:
+            author, separator, _ = self.text.partition(': ')
+            self._author = author if separator and self.direction == INCOMING else ''
+        return self._author or None
+
+    @property
+    def timestamp(self):
+        return None if self.received_at is None else datetime.datetime.fromtimestamp(self.received_at)
+
+    @property
+    def line(self):
+        if self.direction == OUTGOING:
+            return f'{OUTGOING_PREFIX}{self.text}'
+        return self.text
+
+    @property
+    def history_line(self):
+        marker = HISTORY_MARKERS.get(self.direction)
+        return f'{marker}{self.text}' if marker else self.text
+
+    def __str__(self):
+        return self.line
+
+    def __repr__(self):
+        return f'ChatMessage({self.direction}, {self.text!r})'
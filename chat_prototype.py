@@ -1,29 +1,41 @@
-import tkinter as tk
 import asyncio
-import aiofiles
 import datetime
 import os
 import logging
-import async_timeout
 import socket
-from dotenv import load_dotenv
-import gui
-from gui import NicknameReceived, ReadConnectionStateChanged, SendingConnectionStateChanged
-from chat_functions import open_connection, authorise, reconnect, InvalidToken
+import time
+from contextlib import nullcontext
+from functools import partial
+import capture
+import metrics
+from bus import CHAT_TOPIC, SYSTEM_TOPIC, MessageBus
+from chat_message import ChatMessage
+from dedup import ReplayFilter
+from history import HistoryPager, open_history
+from keepalive import Keepalive, keepalive_from_env
+from line_reader import open_line_connection
+from outbox import Outbox
+from queues import drain_queue, queue_from_env
+from chat_events import (CircuitStateChanged, NicknameReceived, ReadConnectionStateChanged, RoundTripMeasured,
+                         SendingConnectionStateChanged, TkAppClosed, status_update_key)
+from chat_functions import open_connection, authorise, connected, supervise, InvalidToken
 import anyio
 
 
-load_dotenv()
-
-
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
 logger = logging.getLogger('chat_prototype')
 watchdog_logger = logging.getLogger('watchdog')
 
 
+def prepare_environment():
+    # dotenv и настройка журнала нужны только при запуске, а не при импорте модуля
+    from dotenv import load_dotenv
+    load_dotenv()
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+
+
 def load_account_hash():
     if os.path.exists('chat_account.hash'):
         with open('chat_account.hash', 'r', encoding='utf-8') as f:
@@ -31,149 +43,339 @@ def load_account_hash():
     return os.environ.get('CHAT_HASH', '')
 
 
-async def load_history(messages_queue, history_file):
-    if not os.path.exists(history_file):
-        return
+async def load_history(messages_queue, history, limit=1000, since=None):
     try:
-        async with aiofiles.open(history_file, mode='r', encoding='utf-8') as f:
-            content = await f.read()
-            lines = content.strip().split('\n')
-            for line in lines:
-                if line.strip():
-                    if '] ' in line:
-                        message = line.split('] ', 1)[1]
-                    else:
-                        message = line
-                    await messages_queue.put(message)
-        logger.info(f"📖 Загружено {len(lines)} сообщений из истории")
+        entries, positions, cursor = await asyncio.to_thread(history.read_page, None, limit, since)
+        for (timestamp, line), position in zip(entries, positions):
+            await messages_queue.put(ChatMessage.from_history(timestamp, line, position))
+        logger.info(f"📖 Загружено {len(entries)} сообщений из истории")
+        return cursor
     except Exception as e:
         logger.error(f"Ошибка загрузки истории: {e}")
+        return None
+
+
+async def save_messages(history, save_queue, flush_size=64 * 1024, flush_interval=1.0, search_index=None):
+    logger.info(f"💾 Сохранение сообщений в файл: {history.history_file} (режим {history.durability})")
 
+    # место строки в истории сообщаем окну и поиску только после сброса на диск, раньше его нельзя прочитать
+    written = []
 
-async def save_messages(history_file, save_queue):
-    logger.info(f"💾 Сохранение сообщений в файл: {history_file}")
+    async def flush():
+        try:
+            await history.flush()
+            for messages, positions in written:
+                for message, position in zip(messages, positions):
+                    message.history_position = position
+                if search_index:
+                    await search_index.add(messages)
+        finally:
+            written.clear()
+        if search_index:
+            await search_index.flush()
+
+    errors_counter = metrics.registry.counter('chat_history_write_errors')
     try:
-        while True:
-            message = await save_queue.get()
-            timestamp = datetime.datetime.now().strftime("[%d.%m.%y %H:%M]")
-            log_entry = f"{timestamp} {message}\n"
-            async with aiofiles.open(history_file, mode='a', encoding='utf-8') as f:
-                await f.write(log_entry)
-                await f.flush()
-            save_queue.task_done()
+        async with history, search_index or nullcontext():
+            unflushed = 0
+            last_flush = time.monotonic()
+            while True:
+                messages = []
+                try:
+                    if unflushed:
+                        wait_time = max(0, flush_interval - (time.monotonic() - last_flush))
+                        try:
+                            message = await asyncio.wait_for(save_queue.get(), wait_time)
+                        except asyncio.TimeoutError:
+                            unflushed = 0
+                            last_flush = time.monotonic()
+                            await flush()
+                            continue
+                    else:
+                        message = await save_queue.get()
+
+                    messages = [message]
+                    while not save_queue.empty():
+                        messages.append(save_queue.get_nowait())
+
+                    entries = [(message.timestamp, message.history_line) for message in messages]
+                    written.append((messages, await history.write(entries)))
+                    unflushed += sum(len(line) for _, line in entries)
+                    if (history.durability != 'buffered' or unflushed >= flush_size
+                            or time.monotonic() - last_flush >= flush_interval):
+                        unflushed = 0
+                        last_flush = time.monotonic()
+                        await flush()
+                except Exception as e:
+                    # сбой записи (нет места на диске, ошибка SQLite) теряет пачку, но не останавливает сохранение,
+                    # иначе блокирующая очередь save заполнится и остановит чтение чата
+                    errors_counter.inc()
+                    logger.error(f"Ошибка сохранения {len(messages) or 'буфера'} сообщений в историю: {e}")
+                finally:
+                    for _ in messages:
+                        save_queue.task_done()
     except asyncio.CancelledError:
         logger.info("Задача сохранения сообщений остановлена")
     except Exception as e:
-        logger.error(f"Ошибка сохранения сообщения: {e}")
+        logger.error(f"Ошибка сохранения сообщения: {e}, история больше не записывается")
+        # очередь save блокирующая: продолжаем её разбирать, чтобы публикация сообщений не встала
+        while True:
+            await save_queue.get()
+            save_queue.task_done()
 
 
-async def watch_for_connection(watchdog_queue, timeout=15):
-    watchdog_logger.info(f"🛡️ Watchdog запущен с таймаутом {timeout}с")
-    while True:
-        try:
-            async with async_timeout.timeout(timeout) as cm:
-                message = await watchdog_queue.get()
-                timestamp = int(datetime.datetime.now().timestamp())
-                if cm.expired:
-                    watchdog_logger.warning(f"[{timestamp}] Позднее уведомление: {message}")
-                else:
-                    watchdog_logger.info(f"[{timestamp}] {message}")
-                watchdog_queue.task_done()
-        except asyncio.TimeoutError:
-            if cm.expired:
-                timestamp = int(datetime.datetime.now().timestamp())
-                watchdog_logger.error(f"[{timestamp}] {timeout}s timeout exceeded - forcing connection close")
-                raise ConnectionError(f"Сервер не отвечает {timeout} секунд")
-        except Exception as e:
-            watchdog_logger.error(f"Ошибка в watchdog: {e}")
-            await asyncio.sleep(1)
+class Heartbeat:
+    def __init__(self):
+        self.last_seen = {}
+        self.reset()
+
+    def reset(self, channel=None):
+        now = time.monotonic()
+        if channel:
+            self.last_seen[channel] = now
+        else:
+            self.last_seen = {'read': now, 'write': now}
+
+    def beat(self, channel, source):
+        self.last_seen[channel] = time.monotonic()
+        # beat вызывается на каждую строку чата, строку журнала собираем только при включённой отладке
+        if watchdog_logger.isEnabledFor(logging.DEBUG):
+            watchdog_logger.debug(f"[{channel}] Connection is alive. Source: {source}")
+
+    def trace(self, channel, event):
+        if watchdog_logger.isEnabledFor(logging.DEBUG):
+            watchdog_logger.debug(f"[{channel}] {event}")
 
+    def idle_time(self, channel):
+        return time.monotonic() - self.last_seen[channel]
 
-async def ping_server(writer, watchdog_queue, ping_interval=10):
-    logger.info(f"🏓 Ping task запущен с интервалом {ping_interval}с")
+
+async def watch_for_connection(heartbeat, channel, timeout, check_interval=1):
+    # timeout - число секунд или функция, если таймаут подстраивается под измеренный RTT
+    current_timeout = timeout() if callable(timeout) else timeout
+    watchdog_logger.info(f"🛡️ Watchdog {channel} запущен с таймаутом {current_timeout:.1f}с")
+    heartbeat.reset(channel)
+    while True:
+        await asyncio.sleep(check_interval)
+        current_timeout = timeout() if callable(timeout) else timeout
+        if current_timeout and heartbeat.idle_time(channel) > current_timeout:
+            timestamp = int(datetime.datetime.now().timestamp())
+            watchdog_logger.error(
+                f"[{timestamp}] {channel}: {current_timeout:.1f}s timeout exceeded - forcing connection close"
+            )
+            raise ConnectionError(f"Сервер не отвечает {current_timeout:.0f} секунд ({channel})")
+
+
+async def ping_server(writer, heartbeat, keepalive, connection_id=0):
+    logger.info(f"🏓 Ping task запущен, ping после {keepalive.idle_interval}с тишины")
     while True:
         try:
-            await asyncio.sleep(ping_interval)
+            idle_left = keepalive.idle_interval - keepalive.idle_time()
+            if idle_left > 0:
+                await asyncio.sleep(idle_left)
+                continue
             writer.write(b"\n\n")
             await writer.drain()
-            await watchdog_queue.put("Connection is alive. Source: Ping sent")
+            capture.recorder.record(capture.SENT, b"\n\n", connection_id)
+            keepalive.ping_sent()
+            if keepalive.srtt is None:
+                # RTT ещё не измерен (ответы на сообщения не в счёт), живость определяем по успешной записи
+                heartbeat.beat('write', "Ping sent")
+            else:
+                heartbeat.trace('write', "Ping sent")
         except (ConnectionError, BrokenPipeError, OSError) as e:
             logger.warning(f"Ошибка при отправке ping: {e}")
-            await watchdog_queue.put(f"Ping error: {e}")
+            heartbeat.trace('write', f"Ping error: {e}")
             raise
         except Exception as e:
             logger.error(f"Неожиданная ошибка в ping: {e}")
             await asyncio.sleep(1)
 
 
-async def read_msgs(host, port, messages_queue, save_queue, status_updates_queue, watchdog_queue):
+async def read_responses(reader, heartbeat, keepalive, status_updates_queue, connection_id=0):
+    rtt_summary = metrics.registry.summary('chat_ping_rtt_seconds')
+    while True:
+        line = await reader.readline()
+        if not line:
+            heartbeat.trace('write', "Connection closed by server")
+            raise ConnectionError("Сервер закрыл соединение для отправки")
+        capture.recorder.record(capture.SEND_REPLY, line, connection_id)
+        rtt = keepalive.response_received()
+        heartbeat.beat('write', "Server response")
+        if rtt is not None:
+            rtt_summary.observe(rtt)
+            await status_updates_queue.put(RoundTripMeasured(keepalive.srtt, keepalive.rttvar, keepalive.timeout()))
+
+
+async def read_msgs(host, port, bus, status_updates_queue, heartbeat, replay_filter=None):
     await status_updates_queue.put(ReadConnectionStateChanged.INITIATED)
     logger.info("Устанавливаем соединение для чтения")
+    writer = None
+    bytes_counter = metrics.registry.counter('chat_socket_bytes', channel='read')
+    lines_counter = metrics.registry.counter('chat_socket_lines', channel='read')
+    replayed_counter = metrics.registry.counter('chat_replayed_lines')
     try:
         reader, writer = await asyncio.open_connection(host, port)
+        connected()
+        connection_id = capture.recorder.new_connection()
+        if replay_filter:
+            replay_filter.start_replay()
         logger.info(f'✅ Подключились к чату {host}:{port}')
-        await save_queue.put(f'Установлено соединение с {host}:{port}')
+        await bus.publish(SYSTEM_TOPIC, ChatMessage.system(f'Установлено соединение с {host}:{port}'))
         await status_updates_queue.put(ReadConnectionStateChanged.ESTABLISHED)
-        await watchdog_queue.put("Connection is alive. Source: Connection established for reading")
+        heartbeat.beat('read', "Connection established for reading")
 
         while True:
             data = await reader.readline()
             if not data:
-                await watchdog_queue.put("Connection closed by server")
-                break
-            message = data.decode().strip()
-            if message:
-                await messages_queue.put(message)
-                await save_queue.put(message)
-                await watchdog_queue.put("Connection is alive. Source: New message in chat")
+                heartbeat.trace('read', "Connection closed by server")
+                raise ConnectionError("Сервер закрыл соединение для чтения")
+            capture.recorder.record(capture.READ, data, connection_id)
+            bytes_counter.inc(len(data))
+            lines_counter.inc()
+            if not data.isspace():
+                message = ChatMessage(data)
+                if replay_filter and replay_filter.is_replayed(message):
+                    replayed_counter.inc()
+                else:
+                    await bus.publish(CHAT_TOPIC, message)
+                heartbeat.beat('read', "New message in chat")
 
     except Exception as e:
         error_msg = f'Ошибка чтения сообщений: {e}'
         logger.error(error_msg)
-        await save_queue.put(error_msg)
+        await bus.publish(SYSTEM_TOPIC, ChatMessage.system(error_msg))
         await status_updates_queue.put(ReadConnectionStateChanged.CLOSED)
-        await watchdog_queue.put(f"Read error: {e}")
+        heartbeat.trace('read', f"Read error: {e}")
         raise
     finally:
-        writer.close()
-        await writer.wait_closed()
+        if writer:
+            writer.close()
+            await writer.wait_closed()
+
+
+async def read_msgs_buffered(host, port, bus, status_updates_queue, heartbeat, replay_filter=None):
+    await status_updates_queue.put(ReadConnectionStateChanged.INITIATED)
+    logger.info("Устанавливаем соединение для чтения")
+    transport = None
+    bytes_counter = metrics.registry.counter('chat_socket_bytes', channel='read')
+    lines_counter = metrics.registry.counter('chat_socket_lines', channel='read')
+    replayed_counter = metrics.registry.counter('chat_replayed_lines')
+    try:
+        transport, lines = await open_line_connection(host, port)
+        connected()
+        if replay_filter:
+            replay_filter.start_replay()
+        logger.info(f'✅ Подключились к чату {host}:{port}')
+        await bus.publish(SYSTEM_TOPIC, ChatMessage.system(f'Установлено соединение с {host}:{port}'))
+        await status_updates_queue.put(ReadConnectionStateChanged.ESTABLISHED)
+        heartbeat.beat('read', "Connection established for reading")
+
+        while True:
+            batch = await lines.read_batch()
+            bytes_counter.inc(sum(map(len, batch)))
+            lines_counter.inc(len(batch))
+            for data in batch:
+                if data.isspace():
+                    continue
+                message = ChatMessage(data)
+                if replay_filter and replay_filter.is_replayed(message):
+                    replayed_counter.inc()
+                else:
+                    await bus.publish(CHAT_TOPIC, message)
+            heartbeat.beat('read', "New messages in chat")
+
+    except Exception as e:
+        error_msg = f'Ошибка чтения сообщений: {e}'
+        logger.error(error_msg)
+        await bus.publish(SYSTEM_TOPIC, ChatMessage.system(error_msg))
+        await status_updates_queue.put(ReadConnectionStateChanged.CLOSED)
+        heartbeat.trace('read', f"Read error: {e}")
+        raise
+    finally:
+        if transport:
+            transport.close()
 
 
-async def send_msgs_with_ping(host, port, account_hash, sending_queue, save_queue, status_updates_queue, watchdog_queue):
+READ_ENGINES = {
+    'stream': read_msgs,
+    'protocol': read_msgs_buffered,
+}
+
+
+def read_engine_from_env():
+    read_engine = os.environ.get('CHAT_READ_ENGINE', 'stream')
+    if read_engine not in READ_ENGINES:
+        raise ValueError(f"Неизвестный движок чтения: {read_engine}, доступны {', '.join(READ_ENGINES)}")
+    return READ_ENGINES[read_engine]
+
+
+async def send_msgs_with_ping(host, port, account_hash, sending_queue, save_queue, status_updates_queue, heartbeat,
+                              authorised_sessions=None, outbox=None, max_batch=100, keepalive=None):
     logger.info(f"📤 Обработчик отправки с ping запущен для {host}:{port}")
+    outbox = outbox or Outbox(None)
+    keepalive = keepalive or Keepalive()
+    writer = None
+    bytes_counter = metrics.registry.counter('chat_socket_bytes', channel='write')
+    lines_counter = metrics.registry.counter('chat_socket_lines', channel='write')
+    drain_summary = metrics.registry.summary('chat_send_drain_seconds')
     try:
-        reader, writer = await asyncio.open_connection(host, port)
-        logger.info(f'✅ Подключились для отправки сообщений к {host}:{port}')
-        await save_queue.put(f'Установлено соединение для отправки с {host}:{port}')
+        if authorised_sessions:
+            reader, writer, account_info = authorised_sessions.pop()
+            logger.info("♻️ Отправляем через соединение, открытое при авторизации")
+        else:
+            await status_updates_queue.put(SendingConnectionStateChanged.INITIATED)
+            reader, writer = await asyncio.open_connection(host, port)
+            logger.info(f'✅ Подключились для отправки сообщений к {host}:{port}')
+            await save_queue.put(ChatMessage.system(f'Установлено соединение для отправки с {host}:{port}'))
+            heartbeat.beat('write', "Connection established for sending")
+
+            account_info = await authorise(reader, writer, account_hash)
+            await status_updates_queue.put(NicknameReceived(account_info['nickname']))
         await status_updates_queue.put(SendingConnectionStateChanged.ESTABLISHED)
-        await watchdog_queue.put("Connection is alive. Source: Connection established for sending")
-
-        account_info = await authorise(reader, writer, account_hash)
+        connected()
+        connection_id = capture.recorder.new_connection()
         nickname = account_info['nickname']
         logger.info(f"🔐 Авторизованы как {nickname} для отправки")
-        await watchdog_queue.put("Connection is alive. Source: Authorization done")
+        heartbeat.beat('write', "Authorization done")
 
-        async with anyio.create_task_group() as ping_group:
-            ping_group.start_soon(ping_server, writer, watchdog_queue, 10)
+        async with outbox, anyio.create_task_group() as ping_group:
+            ping_group.start_soon(ping_server, writer, heartbeat, keepalive, connection_id)
+            ping_group.start_soon(read_responses, reader, heartbeat, keepalive, status_updates_queue, connection_id)
             try:
                 while True:
-                    message = await sending_queue.get()
+                    if not outbox.pending:
+                        messages = drain_queue(sending_queue, await sending_queue.get(), max_batch)
+                        try:
+                            await outbox.add(messages)
+                        finally:
+                            for _ in messages:
+                                sending_queue.task_done()
+
+                    batch = list(outbox.pending)
                     try:
-                        writer.write(f"{message}\n\n".encode())
+                        lines = [f"{message}\n\n".encode() for _, message in batch]
+                        started_at = time.monotonic()
+                        writer.writelines(lines)
                         await writer.drain()
-                        user_message = f"> {message}"
-                        await save_queue.put(user_message)
-                        logger.info(f"📤 Сообщение отправлено на сервер: '{message}'")
-                        await watchdog_queue.put("Connection is alive. Source: Message sent")
+                        keepalive.touch()
+                        drain_summary.observe(time.monotonic() - started_at)
+                        if capture.recorder.enabled:
+                            capture.recorder.record(capture.SENT, b''.join(lines), connection_id)
+                        bytes_counter.inc(sum(map(len, lines)))
+                        lines_counter.inc(len(lines))
                     except Exception as e:
                         error_msg = f"❌ Ошибка отправки сообщения: {e}"
                         logger.error(error_msg)
-                        await save_queue.put(error_msg)
-                        await watchdog_queue.put(f"Message sending error: {e}")
-                        await sending_queue.put(message)
-                        break
-                    finally:
-                        sending_queue.task_done()
+                        await save_queue.put(ChatMessage.system(error_msg))
+                        heartbeat.trace('write', f"Message sending error: {e}")
+                        raise
+
+                    await outbox.acknowledge(batch[-1][0])
+                    for _, message in batch:
+                        await save_queue.put(ChatMessage.outgoing(message))
+                    logger.info(f"📤 Отправлено сообщений на сервер: {len(batch)}")
+                    heartbeat.beat('write', "Message sent")
             except Exception as e:
                 logger.error(f"Ошибка в основной задаче отправки: {e}")
                 raise
@@ -181,35 +383,65 @@ async def send_msgs_with_ping(host, port, account_hash, sending_queue, save_queu
     except Exception as e:
         error_msg = f'Ошибка при отправке сообщений: {e}'
         logger.error(error_msg)
-        await save_queue.put(error_msg)
+        await save_queue.put(ChatMessage.system(error_msg))
         await status_updates_queue.put(SendingConnectionStateChanged.CLOSED)
-        await watchdog_queue.put(f"Sending error: {e}")
+        heartbeat.trace('write', f"Sending error: {e}")
         raise
     finally:
-        writer.close()
-        await writer.wait_closed()
+        if writer:
+            writer.close()
+            await writer.wait_closed()
+
+
+async def read_with_watchdog(host, port, bus, status_updates_queue, heartbeat, timeout, replay_filter=None,
+                             read_engine=read_msgs):
+    async with anyio.create_task_group() as read_group:
+        read_group.start_soon(read_engine, host, port, bus, status_updates_queue, heartbeat, replay_filter)
+        read_group.start_soon(watch_for_connection, heartbeat, 'read', timeout)
+
+
+async def send_with_watchdog(host, port, account_hash, sending_queue, save_queue, status_updates_queue, heartbeat,
+                             timeout, authorised_sessions=None, outbox=None):
+    # timeout действует, пока нет ни одного замера RTT, дальше таймаут считает keepalive
+    keepalive = keepalive_from_env(timeout)
+    async with anyio.create_task_group() as send_group:
+        send_group.start_soon(partial(
+            send_msgs_with_ping, host, port, account_hash, sending_queue, save_queue, status_updates_queue,
+            heartbeat, authorised_sessions, outbox, keepalive=keepalive,
+        ))
+        send_group.start_soon(watch_for_connection, heartbeat, 'write', keepalive.timeout)
+
+
+def report_circuit_state(status_updates_queue, channel):
+    async def on_state_change(state):
+        await status_updates_queue.put(CircuitStateChanged(channel, state))
+    return on_state_change
 
 
-@reconnect(max_retries=10, initial_delay=1, max_delay=60)
-async def handle_connection(host, read_port, send_port, account_hash, messages_queue, sending_queue, 
-                          save_queue, status_updates_queue, watchdog_queue):
+async def handle_connection(host, read_port, send_port, account_hash, bus, sending_queue,
+                            save_queue, status_updates_queue, heartbeat, read_timeout=300, write_timeout=15,
+                            authorised_sessions=None, outbox=None, replay_filter=None, read_engine=read_msgs):
     logger.info("🔄 Запускаем группу задач соединения")
     try:
         async with anyio.create_task_group() as connection_group:
-            connection_group.start_soon(read_msgs, host, read_port, messages_queue, save_queue, status_updates_queue, watchdog_queue)
-            connection_group.start_soon(send_msgs_with_ping, host, send_port, account_hash, sending_queue, save_queue, status_updates_queue, watchdog_queue)
-            connection_group.start_soon(watch_for_connection, watchdog_queue, 15)
-    except (ConnectionError, socket.gaierror, OSError, asyncio.TimeoutError) as e:
-        logger.warning(f"🔌 Соединение разорвано: {e}")
-        await save_queue.put(f"Соединение разорвано: {e}")
-        raise
+            connection_group.start_soon(partial(
+                supervise, read_with_watchdog, host, read_port, bus, status_updates_queue, heartbeat, read_timeout,
+                replay_filter, read_engine=read_engine, name='чтение',
+                on_state_change=report_circuit_state(status_updates_queue, 'read'),
+            ))
+            connection_group.start_soon(partial(
+                supervise, send_with_watchdog, host, send_port, account_hash, sending_queue, save_queue,
+                status_updates_queue, heartbeat, write_timeout, authorised_sessions, outbox,
+                name='отправка', on_state_change=report_circuit_state(status_updates_queue, 'write'),
+            ))
     except Exception as e:
         logger.error(f"❌ Неожиданная ошибка в handle_connection: {e}")
-        await save_queue.put(f"Ошибка соединения: {e}")
+        await save_queue.put(ChatMessage.system(f"Ошибка соединения: {e}"))
         raise
 
 
-async def handle_authorisation(host, port, account_hash, status_updates_queue, save_queue, watchdog_queue):
+async def handle_authorisation(host, port, account_hash, status_updates_queue, save_queue, heartbeat):
+    writer = None
     try:
         logger.info("🔐 Выполняем авторизацию на сервере...")
         await status_updates_queue.put(SendingConnectionStateChanged.INITIATED)
@@ -219,25 +451,74 @@ async def handle_authorisation(host, port, account_hash, status_updates_queue, s
         print(f"✅ Выполнена авторизация. Пользователь {nickname}.")
         await status_updates_queue.put(NicknameReceived(nickname))
         await status_updates_queue.put(SendingConnectionStateChanged.ESTABLISHED)
-        await save_queue.put(f"Авторизованы как: {nickname}")
-        await watchdog_queue.put("Connection is alive. Source: Authorization successful")
+        await save_queue.put(ChatMessage.system(f"Авторизованы как: {nickname}"))
+        heartbeat.beat('write', "Authorization successful")
         logger.info(f"👤 Успешная авторизация: {nickname}")
-        writer.close()
-        await writer.wait_closed()
-        return nickname
+        return reader, writer, account_info
     except InvalidToken as e:
-        await watchdog_queue.put("Authorization failed: Invalid token")
+        heartbeat.trace('write', "Authorization failed: Invalid token")
+        await close_writer(writer)
         raise
     except Exception as e:
         error_msg = f"❌ Ошибка авторизации: {e}"
         logger.error(error_msg)
-        await save_queue.put(error_msg)
+        await save_queue.put(ChatMessage.system(error_msg))
         await status_updates_queue.put(SendingConnectionStateChanged.CLOSED)
-        await watchdog_queue.put(f"Authorization error: {e}")
+        heartbeat.trace('write', f"Authorization error: {e}")
+        await close_writer(writer)
         raise
 
 
+async def close_writer(writer):
+    if writer:
+        writer.close()
+        await asyncio.gather(writer.wait_closed(), return_exceptions=True)
+
+
+async def stop_saving(save_task, save_queue):
+    if not save_task.done():
+        await save_queue.join()
+    save_task.cancel()
+    await asyncio.gather(save_task, return_exceptions=True)
+
+
+def history_from_env():
+    history_file = os.environ.get('CHAT_HISTORY', 'chat_history.txt')
+    history_backend = os.environ.get('CHAT_HISTORY_BACKEND', 'text')
+    history_durability = os.environ.get('CHAT_HISTORY_DURABILITY', 'buffered')
+    flush_size = int(os.environ.get('CHAT_HISTORY_FLUSH_SIZE', str(64 * 1024)))
+    flush_interval = float(os.environ.get('CHAT_HISTORY_FLUSH_INTERVAL', '1.0'))
+    options = {}
+    if history_backend == 'rotating':
+        options['rotate_size'] = int(os.environ.get('CHAT_HISTORY_ROTATE_SIZE', str(16 * 1024 * 1024)))
+        options['rotate_daily'] = os.environ.get('CHAT_HISTORY_ROTATE_DAILY') == '1'
+    history = open_history(history_backend, history_file, history_durability, **options)
+    return history, flush_size, flush_interval
+
+
+def search_index_from_env():
+    index_file = os.environ.get('CHAT_SEARCH_INDEX')
+    if not index_file:
+        return None
+    from search import SearchIndex
+    return SearchIndex(index_file)
+
+
+async def replay_filter_from_env(history):
+    window = int(os.environ.get('CHAT_DEDUP_WINDOW', '1000'))
+    if not window:
+        return None
+    replay_filter = ReplayFilter(window, float(os.environ.get('CHAT_DEDUP_REPLAY_PERIOD', '5')))
+    try:
+        entries, _ = await asyncio.to_thread(history.tail, window)
+        replay_filter.seed(ChatMessage.from_history(timestamp, line) for timestamp, line in entries)
+    except Exception as e:
+        logger.error(f"Ошибка загрузки истории для фильтра повторов: {e}")
+    return replay_filter
+
+
 async def start_chat():
+    import gui
     account_hash = load_account_hash()
     if not account_hash:
         print("❌ Токен не найден. Запустите registration.py для регистрации.")
@@ -246,24 +527,58 @@ async def start_chat():
     host = os.environ.get('CHAT_HOST', 'minechat.dvmn.org')
     read_port = int(os.environ.get('LISTEN_CHAT_PORT', '5000'))
     send_port = int(os.environ.get('MESSAGE_CHAT_PORT', '5050'))
-    history_file = os.environ.get('CHAT_HISTORY', 'chat_history.txt')
+    outbox_file = os.environ.get('CHAT_OUTBOX', 'chat_outbox.jsonl')
+    outbox_durability = os.environ.get('CHAT_OUTBOX_DURABILITY', 'flush')
+    history_tail = int(os.environ.get('CHAT_HISTORY_TAIL', '1000'))
+    history_tail_hours = float(os.environ.get('CHAT_HISTORY_TAIL_HOURS', '0'))
+    history_page_size = int(os.environ.get('CHAT_HISTORY_PAGE_SIZE', '200'))
+    scrollback_lines = int(os.environ.get('CHAT_SCROLLBACK_LINES', '5000'))
+    tk_idle_interval = float(os.environ.get('CHAT_TK_IDLE_INTERVAL', str(1 / 20)))
+    read_timeout = float(os.environ.get('CHAT_READ_TIMEOUT', '300'))
+    write_timeout = float(os.environ.get('CHAT_WRITE_TIMEOUT', '15'))
+    if os.environ.get('CHAT_WATCHDOG_TRACE') == '1':
+        watchdog_logger.setLevel(logging.DEBUG)
+    metrics.enable_from_env()
 
     print("🚀 Запуск графического чата...")
 
-    messages_queue = asyncio.Queue()
-    sending_queue = asyncio.Queue()
-    status_updates_queue = asyncio.Queue()
-    save_queue = asyncio.Queue()
-    watchdog_queue = asyncio.Queue()
+    messages_queue = queue_from_env('messages', 10000, 'drop_oldest')
+    sending_queue = queue_from_env('sending', 1000, 'block')
+    status_updates_queue = queue_from_env('status', 100, 'coalesce', coalesce_key=status_update_key)
+    save_queue = queue_from_env('save', 10000, 'block')
+    heartbeat = Heartbeat()
+    outbox = await asyncio.to_thread(Outbox(outbox_file, outbox_durability).load)
+
+    bus = MessageBus()
+    bus.subscribe(messages_queue, CHAT_TOPIC)
+    bus.subscribe(save_queue, CHAT_TOPIC, SYSTEM_TOPIC)
 
-    await load_history(messages_queue, history_file)
+    try:
+        read_engine = read_engine_from_env()
+        history, history_flush_size, history_flush_interval = history_from_env()
+    except ValueError as e:
+        print(f"❌ {e}")
+        return
+    search_index = search_index_from_env()
+    save_task = asyncio.create_task(save_messages(history, save_queue, history_flush_size, history_flush_interval,
+                                                  search_index))
+
+    history_since = None
+    if history_tail_hours:
+        history_since = datetime.datetime.now() - datetime.timedelta(hours=history_tail_hours)
+    history_cursor = await load_history(messages_queue, history, history_tail, history_since)
+    history_pager = HistoryPager(history, history_cursor, history_page_size)
+    replay_filter = await replay_filter_from_env(history)
 
     try:
-        nickname = await handle_authorisation(host, send_port, account_hash, status_updates_queue, save_queue, watchdog_queue)
+        authorised_session = await handle_authorisation(host, send_port, account_hash, status_updates_queue,
+                                                        save_queue, heartbeat)
     except InvalidToken as e:
+        await stop_saving(save_task, save_queue)
         print(f"❌ {e}")
         print("Пожалуйста, проверьте токен или зарегистрируйтесь заново.")
         try:
+            import tkinter as tk
             root = tk.Tk()
             root.withdraw()
             gui.show_token_error()
@@ -272,37 +587,44 @@ async def start_chat():
             print(f"Не удалось показать GUI-уведомление: {gui_error}")
         return
     except Exception as e:
+        await stop_saving(save_task, save_queue)
         print(f"❌ Не удалось запустить приложение: {e}")
         return
 
+    capture.enable_from_env()
     try:
         async with anyio.create_task_group() as main_group:
-            main_group.start_soon(gui.draw, messages_queue, sending_queue, status_updates_queue)
-            main_group.start_soon(save_messages, history_file, save_queue)
+            main_group.start_soon(gui.draw, messages_queue, sending_queue, status_updates_queue,
+                                  history_pager, scrollback_lines, tk_idle_interval, search_index)
             main_group.start_soon(handle_connection, host, read_port, send_port, account_hash,
-                                messages_queue, sending_queue, save_queue, status_updates_queue, watchdog_queue)
-    except (gui.TkAppClosed, KeyboardInterrupt):
+                                bus, sending_queue, save_queue, status_updates_queue, heartbeat,
+                                read_timeout, write_timeout, [authorised_session], outbox, replay_filter,
+                                read_engine)
+            main_group.start_soon(metrics.export_metrics)
+    except (TkAppClosed, KeyboardInterrupt):
         print("👋 Приложение завершено пользователем")
-        await save_queue.put("Приложение закрыто пользователем")
+        await save_queue.put(ChatMessage.system("Приложение закрыто пользователем"))
     except Exception as e:
         if not isinstance(e, (ConnectionError, socket.gaierror, OSError, asyncio.TimeoutError)):
             error_msg = f"Произошла непредвиденная ошибка: {e}"
             print(error_msg)
-            await save_queue.put(error_msg)
+            await save_queue.put(ChatMessage.system(error_msg))
         else:
             print(f"🔌 Соединение прервано: {e}")
     finally:
-        await save_queue.join()
+        await stop_saving(save_task, save_queue)
+        capture.close()
         print("✅ Все задачи завершены")
 
 
 def main():
+    prepare_environment()
     try:
         asyncio.run(start_chat())
     except KeyboardInterrupt:
         print("\n⏹️ Приложение завершено по команде пользователя")
     except Exception as e:
-        if not isinstance(e, (ConnectionError, gui.TkAppClosed)):
+        if not isinstance(e, (ConnectionError, TkAppClosed)):
             print(f"❌ Критическая ошибка: {e}")
 
 
@@ -0,0 +1,113 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import signal
+import sys
+from functools import partial
+
+import anyio
+
+import capture
+import metrics
+from bus import CHAT_TOPIC, SYSTEM_TOPIC, MessageBus
+from chat_events import CircuitStateChanged, ReadConnectionStateChanged, status_update_key
+from chat_functions import supervise
+from chat_prototype import (Heartbeat, history_from_env, prepare_environment, read_engine_from_env,
+                            read_with_watchdog, replay_filter_from_env, report_circuit_state, save_messages,
+                            search_index_from_env, stop_saving)
+from queues import drain_queue, queue_from_env
+
+
+logger = logging.getLogger('chat_reader')
+
+OUTPUT_FORMATS = ('json', 'text', 'none')
+
+
+def format_messages(messages, output_format):
+    if output_format == 'text':
+        return ''.join(f"{message.line}\n" for message in messages)
+    return ''.join(
+        json.dumps({
+            'received_at': message.timestamp.isoformat(timespec='milliseconds'),
+            'author': message.author,
+            'message': message.text,
+        }, ensure_ascii=False) + '\n'
+        for message in messages
+    )
+
+
+async def stream_messages(messages_queue, output_format, stream=sys.stdout, max_batch=1000):
+    while True:
+        messages = drain_queue(messages_queue, await messages_queue.get(), max_batch)
+        stream.write(format_messages(messages, output_format))
+        stream.flush()
+
+
+async def log_status_updates(status_updates_queue):
+    while True:
+        update = await status_updates_queue.get()
+        if isinstance(update, ReadConnectionStateChanged):
+            logger.info(f"📡 Соединение для чтения: {update.value}")
+        elif isinstance(update, CircuitStateChanged):
+            logger.info(f"🔁 Переподключение ({update.channel}): {update.state.value}")
+
+
+async def run_reader(output_format):
+    host = os.environ.get('CHAT_HOST', 'minechat.dvmn.org')
+    read_port = int(os.environ.get('LISTEN_CHAT_PORT', '5000'))
+    read_timeout = float(os.environ.get('CHAT_READ_TIMEOUT', '300'))
+
+    read_engine = read_engine_from_env()
+    metrics.enable_from_env()
+    capture.enable_from_env()
+    status_updates_queue = queue_from_env('status', 100, 'coalesce', coalesce_key=status_update_key)
+    save_queue = queue_from_env('save', 10000, 'block')
+    bus = MessageBus()
+    bus.subscribe(save_queue, CHAT_TOPIC, SYSTEM_TOPIC)
+    messages_queue = None
+    if output_format != 'none':
+        messages_queue = bus.subscribe(queue_from_env('messages', 10000, 'drop_oldest'), CHAT_TOPIC)
+
+    history, flush_size, flush_interval = history_from_env()
+    replay_filter = await replay_filter_from_env(history)
+    save_task = asyncio.create_task(save_messages(history, save_queue, flush_size, flush_interval,
+                                                  search_index_from_env()))
+
+    # SIGTERM от systemd/docker завершает так же, как Ctrl+C: история дописывается до конца
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+    logger.info(f"🛰️ Чтение {host}:{read_port} без GUI, вывод: {output_format}")
+    try:
+        async with anyio.create_task_group() as reader_group:
+            reader_group.start_soon(partial(
+                supervise, read_with_watchdog, host, read_port, bus, status_updates_queue, Heartbeat(),
+                read_timeout, replay_filter, read_engine=read_engine, name='чтение',
+                on_state_change=report_circuit_state(status_updates_queue, 'read'),
+            ))
+            reader_group.start_soon(log_status_updates, status_updates_queue)
+            if messages_queue is not None:
+                reader_group.start_soon(stream_messages, messages_queue, output_format)
+            reader_group.start_soon(metrics.export_metrics)
+    finally:
+        await stop_saving(save_task, save_queue)
+        capture.close()
+        logger.info("✅ История сохранена")
+
+
+def main():
+    prepare_environment()
+    parser = argparse.ArgumentParser(description='Чтение чата без графического интерфейса')
+    parser.add_argument(
+        '--output', choices=OUTPUT_FORMATS, default=os.environ.get('CHAT_READER_OUTPUT', 'json'),
+        help='json - JSON-строки в stdout, text - как в окне чата, none - только в историю',
+    )
+    args = parser.parse_args()
+    try:
+        asyncio.run(run_reader(args.output))
+    except (KeyboardInterrupt, asyncio.CancelledError, BrokenPipeError):
+        pass
+
+
+if __name__ == '__main__':
+    main()
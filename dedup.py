@@ -0,0 +1,56 @@
+import time
+from collections import Counter, deque
+
+from chat_message import INCOMING
+
+
+def fingerprint(message):
+    # отпечаток по байтам строки, чтобы не декодировать каждую входящую строку ради сравнения
+    raw = message.text.encode('utf-8') if message.raw is None else message.raw
+    return hash(raw.strip())
+
+
+class ReplayFilter:
+    # после подключения сервер повторяет последние сообщения чата; помним отпечатки недавних строк,
+    # чтобы не показывать и не записывать их второй раз
+    def __init__(self, window=1000, replay_period=5):
+        self.window = window
+        self.replay_period = replay_period
+        self.fingerprints = deque()
+        self.counts = Counter()
+        self.replaying = False
+        self.replay_deadline = 0
+        self.replay_budget = 0
+
+    def seed(self, messages):
+        for message in messages:
+            if message.direction == INCOMING:
+                self.remember(fingerprint(message))
+
+    def remember(self, fingerprint):
+        self.fingerprints.append(fingerprint)
+        self.counts[fingerprint] += 1
+        if len(self.fingerprints) > self.window:
+            oldest = self.fingerprints.popleft()
+            self.counts[oldest] -= 1
+            if not self.counts[oldest]:
+                del self.counts[oldest]
+
+    def start_replay(self):
+        # сервер отдаёт повтор сразу и не больше, чем помнит сам, поэтому окно ограничено
+        # и по времени, и по числу строк
+        self.replaying = True
+        self.replay_deadline = time.monotonic() + self.replay_period
+        self.replay_budget = self.window
+
+    def is_replayed(self, message):
+        message_fingerprint = fingerprint(message)
+        # повтор - только непрерывный блок уже известных строк сразу после подключения,
+        # одинаковые сообщения, пришедшие позже, остаются в чате
+        if (self.replaying and message_fingerprint in self.counts and self.replay_budget
+                and time.monotonic() < self.replay_deadline):
+            self.replay_budget -= 1
+            return True
+        self.replaying = False
+        self.remember(message_fingerprint)
+        return False
@@ -0,0 +1,183 @@
+import argparse
+import asyncio
+import json
+import logging
+import secrets
+import time
+from collections import deque
+
+
+logger = logging.getLogger('fake_server')
+
+GREETING = b'Hello %username%! Enter your personal hash or leave it empty to create new account.\n'
+NICKNAME_PROMPT = b'Enter preferred nickname below:\n'
+MESSAGE_SENT = b'Message send. Write more\n'
+
+
+class StandInServer:
+    def __init__(self, host='127.0.0.1', listen_port=0, send_port=0, replay=0):
+        self.host = host
+        self.listen_port = listen_port
+        self.send_port = send_port
+        self.accounts = {}
+        self.listeners = set()
+        self.servers = []
+        self.handlers = set()
+        self.received_lines = 0
+        # как настоящий сервер, новому слушателю сначала отдаём последние сообщения
+        self.recent = deque(maxlen=replay)
+
+    async def start(self):
+        listen_server = await asyncio.start_server(self.handle_listener, self.host, self.listen_port)
+        send_server = await asyncio.start_server(self.handle_sender, self.host, self.send_port)
+        self.servers = [listen_server, send_server]
+        self.listen_port = listen_server.sockets[0].getsockname()[1]
+        self.send_port = send_server.sockets[0].getsockname()[1]
+        logger.info(f"🧪 Тестовый сервер: чтение {self.host}:{self.listen_port}, отправка {self.host}:{self.send_port}")
+        return self
+
+    async def stop(self):
+        for server in self.servers:
+            server.close()
+        for writer, _ in list(self.handlers):
+            writer.close()
+        await asyncio.gather(*(handler for _, handler in self.handlers), return_exceptions=True)
+        for server in self.servers:
+            await server.wait_closed()
+
+    def track_handler(self, writer):
+        handler = (writer, asyncio.current_task())
+        self.handlers.add(handler)
+        return handler
+
+    def add_account(self, nickname, account_hash=None):
+        account_hash = account_hash or secrets.token_hex(16)
+        self.accounts[account_hash] = {'nickname': nickname, 'account_hash': account_hash}
+        return account_hash
+
+    async def handle_listener(self, reader, writer):
+        handler = self.track_handler(writer)
+        self.listeners.add(writer)
+        writer.writelines(self.recent)
+        try:
+            await reader.read()
+        except ConnectionError:
+            pass
+        finally:
+            self.listeners.discard(writer)
+            self.handlers.discard(handler)
+            writer.close()
+
+    async def handle_sender(self, reader, writer):
+        handler = self.track_handler(writer)
+        try:
+            writer.write(GREETING)
+            await writer.drain()
+            account_hash = (await reader.readline()).decode().strip()
+            if account_hash:
+                account_info = self.accounts.get(account_hash)
+            else:
+                writer.write(NICKNAME_PROMPT)
+                await writer.drain()
+                nickname = (await reader.readline()).decode().strip()
+                account_info = self.accounts[self.add_account(nickname)]
+            writer.write(json.dumps(account_info).encode() + b'\n')
+            await writer.drain()
+            if not account_info:
+                return
+
+            message_lines = []
+            while line := await reader.readline():
+                line = line.decode().strip()
+                if line:
+                    message_lines.append(line)
+                    continue
+                if message_lines:
+                    self.broadcast(f"{account_info['nickname']}: {' '.join(message_lines)}")
+                    message_lines = []
+                # подтверждение на каждую пустую строку, по нему клиент меряет RTT
+                writer.write(MESSAGE_SENT)
+        except ConnectionError:
+            pass
+        finally:
+            self.handlers.discard(handler)
+            writer.close()
+
+    def broadcast(self, message):
+        self.received_lines += 1
+        data = message.encode() + b'\n'
+        self.recent.append(data)
+        for listener in list(self.listeners):
+            listener.write(data)
+
+    async def drain_listeners(self):
+        for listener in list(self.listeners):
+            try:
+                await listener.drain()
+            except ConnectionError:
+                self.listeners.discard(listener)
+
+    def drop_listeners(self):
+        for listener in list(self.listeners):
+            listener.close()
+        self.listeners.clear()
+
+    async def wait_for_listeners(self, count=1):
+        while len(self.listeners) < count:
+            await asyncio.sleep(0.001)
+
+    async def flood(self, count=None, rate=None, line_size=80, drop_every=None):
+        padding = 'x' * line_size
+        started_at = time.monotonic()
+        last_drop = started_at
+        sent = 0
+        while count is None or sent < count:
+            self.broadcast(f"{sent} {time.perf_counter():.9f} {padding}")
+            sent += 1
+            if drop_every and time.monotonic() - last_drop >= drop_every:
+                self.drop_listeners()
+                last_drop = time.monotonic()
+            if rate:
+                delay = started_at + sent / rate - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            elif sent % 100 == 0:
+                await self.drain_listeners()
+        return sent
+
+
+async def run_server(args):
+    server = await StandInServer(args.host, args.listen_port, args.send_port, args.replay).start()
+    if args.token:
+        server.add_account(args.nickname, args.token)
+    try:
+        if args.rate or args.count:
+            await server.wait_for_listeners()
+            await server.flood(args.count, args.rate, args.line_size, args.drop_every)
+        await asyncio.Event().wait()
+    finally:
+        await server.stop()
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description='Локальный сервер-заменитель minechat и генератор нагрузки')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--listen-port', type=int, default=5000)
+    parser.add_argument('--send-port', type=int, default=5050)
+    parser.add_argument('--token', help='заранее зарегистрированный токен')
+    parser.add_argument('--nickname', default='tester')
+    parser.add_argument('--rate', type=float, help='сообщений в секунду в порт чтения')
+    parser.add_argument('--count', type=int, help='сколько сообщений отправить')
+    parser.add_argument('--line-size', type=int, default=80)
+    parser.add_argument('--drop-every', type=float, help='разрывать соединения чтения каждые N секунд')
+    parser.add_argument('--replay', type=int, default=0, help='сколько последних сообщений отдавать при подключении')
+    args = parser.parse_args()
+    try:
+        asyncio.run(run_server(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
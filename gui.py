@@ -1,87 +1,269 @@
 import tkinter as tk
 import asyncio
+import logging
+import time
 import anyio
+import metrics
 from tkinter.scrolledtext import ScrolledText
-from enum import Enum
 import tkinter.messagebox as messagebox
+from chat_functions import CircuitState
+from chat_events import (CircuitStateChanged, NicknameReceived, ReadConnectionStateChanged, RoundTripMeasured,
+                         SendingConnectionStateChanged, TkAppClosed)
+from queues import drain_queue
 
 
-class TkAppClosed(Exception):
-    pass
+logger = logging.getLogger('gui')
 
 
-class ReadConnectionStateChanged(Enum):
-    INITIATED = 'устанавливаем соединение'
-    ESTABLISHED = 'соединение установлено'
-    CLOSED = 'соединение закрыто'
-
-    def __str__(self):
-        return str(self.value)
-
+def process_new_message(input_field, sending_queue):
+    text = input_field.get()
+    try:
+        sending_queue.put_nowait(text)
+    except asyncio.QueueFull:
+        # очередь отправки заполнена - оставляем текст в поле ввода
+        return
+    input_field.delete(0, tk.END)
 
-class SendingConnectionStateChanged(Enum):
-    INITIATED = 'устанавливаем соединение'
-    ESTABLISHED = 'соединение установлено'
-    CLOSED = 'соединение закрыто'
 
-    def __str__(self):
-        return str(self.value)
+class TkActivity:
+    # будит update_tk из asyncio-кода, например при отрисовке новых сообщений; привязки Tk к вводу
+    # срабатывают только внутри root.update(), поэтому первое нажатие после простоя ждёт
+    # до idle_interval, а дальше опрос снова идёт с частотой interval
+    def __init__(self):
+        self.last_activity = time.monotonic()
+        self.wakeup = asyncio.Event()
 
+    def touch(self, event=None):
+        self.last_activity = time.monotonic()
+        self.wakeup.set()
 
-class NicknameReceived:
-    def __init__(self, nickname):
-        self.nickname = nickname
+    def watch_input(self, root):
+        for sequence in ('<Key>', '<Button>', '<Motion>', '<MouseWheel>', '<Configure>'):
+            root.bind_all(sequence, self.touch, add='+')
 
 
-def process_new_message(input_field, sending_queue):
-    text = input_field.get()
-    sending_queue.put_nowait(text)
-    input_field.delete(0, tk.END)
-
-
-async def update_tk(root_frame, interval=1 / 120):
+async def update_tk(root_frame, activity=None, interval=1 / 120, idle_interval=1 / 20, active_period=1.0):
+    activity = activity or TkActivity()
+    current_interval = interval
     while True:
         try:
             root_frame.update()
         except tk.TclError:
             # if application has been destroyed/closed
             raise TkAppClosed()
-        await asyncio.sleep(interval)
+
+        if time.monotonic() - activity.last_activity < active_period:
+            current_interval = interval
+        else:
+            current_interval = min(current_interval * 2, idle_interval)
+
+        activity.wakeup.clear()
+        try:
+            await asyncio.wait_for(activity.wakeup.wait(), current_interval)
+        except asyncio.TimeoutError:
+            pass
 
 
-async def update_conversation_history(panel, messages_queue):
+async def update_conversation_history(panel, messages_queue, history_pager=None, scrollback_lines=5000,
+                                      activity=None, trim_chunk=500, frame_budget=1 / 120, max_batch=1000):
+    batch_size = max_batch
+    render_summary = metrics.registry.summary('chat_render_batch_seconds')
+    latency_summary = metrics.registry.summary('chat_read_to_render_seconds')
     while True:
-        msg = await messages_queue.get()
+        messages = drain_queue(messages_queue, await messages_queue.get(), batch_size)
+        started_at = time.monotonic()
+        following = panel.yview()[1] >= 1.0
 
+        text = '\n'.join(message.line for message in messages)
         panel['state'] = 'normal'
         if panel.index('end-1c') != '1.0':
-            panel.insert('end', '\n')
-        panel.insert('end', msg)
-        # TODO сделать промотку умной, чтобы не мешала просматривать историю сообщений
-        # ScrolledText.frame
-        # ScrolledText.vbar
-        panel.yview(tk.END)
+            text = '\n' + text
+        panel.insert('end', text)
+        if history_pager:
+            history_pager.show(messages)
+
+        if following:
+            line_count = int(panel.index('end-1c').split('.')[0])
+            # пока подгружается старая страница, окно не обрезаем: она встанет над текущей верхней строкой
+            loading_older = history_pager and history_pager.lock.locked()
+            if scrollback_lines and line_count > scrollback_lines and not loading_older:
+                trimmed = min(line_count - scrollback_lines + trim_chunk, line_count - 1)
+                panel.delete('1.0', f'{trimmed + 1}.0')
+                if history_pager:
+                    history_pager.trim(trimmed)
+            panel.yview(tk.END)
         panel['state'] = 'disabled'
+        if activity:
+            activity.touch()
 
+        elapsed = time.monotonic() - started_at
+        render_summary.observe(elapsed)
+        latency_summary.observe(time.monotonic() - messages[0].received_monotonic)
+        if elapsed > frame_budget:
+            batch_size = max(1, batch_size // 2)
+        elif elapsed < frame_budget / 2 and len(messages) == batch_size:
+            batch_size = min(max_batch, batch_size * 2)
 
-async def update_status_panel(status_labels, status_updates_queue):
-    nickname_label, read_label, write_label = status_labels
+        if not messages_queue.empty():
+            # отдаём кадр Tk, чтобы большой поток сообщений не блокировал ввод
+            await asyncio.sleep(frame_budget)
+
+
+def watch_scroll_top(panel, history_pager, older_history_requested):
+    def on_scroll(first, last):
+        panel.vbar.set(first, last)
+        if float(first) == 0.0 and history_pager.has_more:
+            older_history_requested.set()
+
+    panel['yscrollcommand'] = on_scroll
+
+
+async def insert_older_page(panel, history_pager, activity=None):
+    async with history_pager.lock:
+        messages = await history_pager.load_older()
+        if not messages:
+            return messages
+
+        top_line = int(panel.index('@0,0').split('.')[0])
+        text = '\n'.join(message.line for message in messages)
+        panel['state'] = 'normal'
+        if panel.index('end-1c') != '1.0':
+            text += '\n'
+        panel.insert('1.0', text)
+        panel.yview(f'{top_line + len(messages)}.0')
+        panel['state'] = 'disabled'
+        if activity:
+            activity.touch()
+        return messages
+
+
+async def load_older_history(panel, history_pager, older_history_requested, activity=None):
+    while history_pager.has_more:
+        await older_history_requested.wait()
+        older_history_requested.clear()
+        await insert_older_page(panel, history_pager, activity)
 
-    read_label['text'] = f'Чтение: нет соединения'
-    write_label['text'] = f'Отправка: нет соединения'
+
+def same_message(message, hit, exact):
+    if message.history_position is not None and hit.history_position is not None:
+        return message.history_position == hit.history_position
+    # места в истории нет (ротируемая история) - сверяем текст и время: точное у сообщений, пришедших
+    # при этом запуске, и до минуты у прочитанных из истории
+    if message.direction != hit.direction or message.text != hit.text:
+        return False
+    if message.received_at is None or hit.received_at is None:
+        return False
+    if exact:
+        return message.received_at == hit.received_at
+    return message.received_at // 60 == hit.received_at // 60
+
+
+def older_than(message, hit):
+    if isinstance(message.history_position, int) and isinstance(hit.history_position, int):
+        return message.history_position < hit.history_position
+    return message.received_at is not None and hit.received_at is not None and message.received_at < hit.received_at - 60
+
+
+def find_shown_line(history_pager, hit):
+    # строки окна идут в том же порядке, что и history_pager.shown; ищем с конца, от самых свежих
+    for exact in (True, False):
+        for line_number in range(len(history_pager.shown), 0, -1):
+            if same_message(history_pager.shown[line_number - 1], hit, exact):
+                return f'{line_number}.0'
+    return None
+
+
+async def jump_to_message(panel, message, history_pager=None, activity=None):
+    passed_message = False
+    while True:
+        if history_pager:
+            index = find_shown_line(history_pager, message)
+        else:
+            index = panel.search(message.line, 'end', backwards=True, exact=True)
+        if index:
+            panel.tag_remove('search_hit', '1.0', tk.END)
+            panel.tag_add('search_hit', index, f'{index} lineend')
+            panel.see(index)
+            return True
+        if passed_message or not history_pager or not history_pager.has_more:
+            return False
+        messages = await insert_older_page(panel, history_pager, activity)
+        # страница уже старше найденного сообщения - дальше искать бессмысленно
+        passed_message = not messages or older_than(messages[0], message)
+
+
+async def search_history(panel, results_list, search_index, search_requests, history_pager=None, activity=None):
+    hits = []
+    while True:
+        request, value = await search_requests.get()
+        if request == 'search':
+            results_list.delete(0, tk.END)
+            try:
+                hits = await asyncio.to_thread(search_index.search, value)
+            except Exception as e:
+                hits = []
+                results_list.insert(tk.END, f'Ошибка поиска: {e}')
+            else:
+                for hit in hits:
+                    stamp = f'{hit.timestamp:%d.%m.%y %H:%M} ' if hit.timestamp else ''
+                    results_list.insert(tk.END, f'{stamp}{hit.line}')
+                if not hits:
+                    results_list.insert(tk.END, 'Ничего не найдено')
+        elif request == 'jump' and value < len(hits):
+            if not await jump_to_message(panel, hits[value], history_pager, activity):
+                results_list.insert(tk.END, 'Сообщение не найдено в истории окна')
+        if activity:
+            activity.touch()
+
+
+async def update_status_panel(status_labels, status_updates_queue, activity=None):
+    nickname_label, read_label, write_label = status_labels
+    channel_labels = {'read': (read_label, 'Чтение'), 'write': (write_label, 'Отправка')}
+    connection_states = {'read': 'нет соединения', 'write': 'нет соединения'}
+    circuit_states = {'read': CircuitState.CLOSED, 'write': CircuitState.CLOSED}
+    round_trips = {'read': None, 'write': None}
+
+    def show_channel(channel):
+        label, title = channel_labels[channel]
+        text = f'{title}: {connection_states[channel]}'
+        round_trip = round_trips[channel]
+        if round_trip:
+            text += (f', RTT {round_trip.rtt * 1000:.0f} ± {round_trip.jitter * 1000:.0f} мс,'
+                     f' таймаут {round_trip.timeout:.0f} с')
+        if circuit_states[channel] != CircuitState.CLOSED:
+            text += f' (автомат переподключения {circuit_states[channel]})'
+        label['text'] = text
+
+    show_channel('read')
+    show_channel('write')
     nickname_label['text'] = f'Имя пользователя: неизвестно'
 
     while True:
         msg = await status_updates_queue.get()
         if isinstance(msg, ReadConnectionStateChanged):
-            read_label['text'] = f'Чтение: {msg}'
+            connection_states['read'] = msg
+            show_channel('read')
 
         if isinstance(msg, SendingConnectionStateChanged):
-            write_label['text'] = f'Отправка: {msg}'
+            connection_states['write'] = msg
+            if msg != SendingConnectionStateChanged.ESTABLISHED:
+                round_trips['write'] = None
+            show_channel('write')
+
+        if isinstance(msg, RoundTripMeasured):
+            round_trips['write'] = msg
+            show_channel('write')
+
+        if isinstance(msg, CircuitStateChanged):
+            circuit_states[msg.channel] = msg.state
+            show_channel(msg.channel)
 
         if isinstance(msg, NicknameReceived):
             nickname_label['text'] = f'Имя пользователя: {msg.nickname}'
 
+        if activity:
+            activity.touch()
+
 
 def create_status_panel(root_frame):
     status_frame = tk.Frame(root_frame)
@@ -102,6 +284,34 @@ def create_status_panel(root_frame):
     return (nickname_label, status_read_label, status_write_label)
 
 
+def create_search_panel(root_frame, search_requests):
+    search_frame = tk.Frame(root_frame)
+    search_frame.pack(side="top", fill=tk.X)
+
+    query_frame = tk.Frame(search_frame)
+    query_frame.pack(side="top", fill=tk.X)
+
+    query_field = tk.Entry(query_frame)
+    query_field.pack(side="left", fill=tk.X, expand=True)
+    query_field.bind("<Return>", lambda event: search_requests.put_nowait(('search', query_field.get())))
+
+    search_button = tk.Button(query_frame)
+    search_button["text"] = "Найти"
+    search_button["command"] = lambda: search_requests.put_nowait(('search', query_field.get()))
+    search_button.pack(side="left")
+
+    results_list = tk.Listbox(search_frame, height=5)
+    results_list.pack(side="top", fill=tk.X)
+
+    def on_select(event):
+        selection = results_list.curselection()
+        if selection:
+            search_requests.put_nowait(('jump', selection[0]))
+
+    results_list.bind('<<ListboxSelect>>', on_select)
+    return results_list
+
+
 def show_token_error():
     messagebox.showerror(
         "Ошибка авторизации",
@@ -110,7 +320,8 @@ def show_token_error():
     )
 
 
-async def draw(messages_queue, sending_queue, status_updates_queue):
+async def draw(messages_queue, sending_queue, status_updates_queue, history_pager=None, scrollback_lines=5000,
+               idle_interval=1 / 20, search_index=None):
     root = tk.Tk()
 
     root.title('Чат Майнкрафтера')
@@ -120,6 +331,11 @@ async def draw(messages_queue, sending_queue, status_updates_queue):
 
     status_labels = create_status_panel(root_frame)
 
+    search_requests = asyncio.Queue()
+    results_list = None
+    if search_index:
+        results_list = create_search_panel(root_frame, search_requests)
+
     input_frame = tk.Frame(root_frame)
     input_frame.pack(side="bottom", fill=tk.X)
 
@@ -135,9 +351,26 @@ async def draw(messages_queue, sending_queue, status_updates_queue):
 
     conversation_panel = ScrolledText(root_frame, wrap='none')
     conversation_panel.pack(side="top", fill="both", expand=True)
+    conversation_panel.tag_configure('search_hit', background='yellow')
+
+    activity = TkActivity()
+    activity.watch_input(root)
+
+    older_history_requested = asyncio.Event()
+    if history_pager:
+        watch_scroll_top(conversation_panel, history_pager, older_history_requested)
 
+    root.update()
+    logger.info("🪟 Окно чата открыто")
 
     async with anyio.create_task_group() as gui_group:
-        gui_group.start_soon(update_tk, root_frame)
-        gui_group.start_soon(update_conversation_history, conversation_panel, messages_queue)
-        gui_group.start_soon(update_status_panel, status_labels, status_updates_queue)
\ No newline at end of file
+        gui_group.start_soon(update_tk, root_frame, activity, 1 / 120, idle_interval)
+        gui_group.start_soon(update_conversation_history, conversation_panel, messages_queue,
+                             history_pager, scrollback_lines, activity)
+        gui_group.start_soon(update_status_panel, status_labels, status_updates_queue, activity)
+        if history_pager:
+            gui_group.start_soon(load_older_history, conversation_panel, history_pager,
+                                 older_history_requested, activity)
+        if search_index:
+            gui_group.start_soon(search_history, conversation_panel, results_list, search_index,
+                                 search_requests, history_pager, activity)
\ No newline at end of file
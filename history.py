@@ -0,0 +1,555 @@
+import asyncio
+import datetime
+import gzip
+import io
+import logging
+import os
+import re
+import shutil
+import threading
+from collections import deque
+from contextlib import closing
+
+import aiofiles
+
+from chat_message import ChatMessage
+
+
+logger = logging.getLogger('history')
+
+TIMESTAMP_FORMAT = "[%d.%m.%y %H:%M]"
+IMPORT_BATCH_SIZE = 10000
+MAX_ROW_ID = 2 ** 63 - 1
+SEGMENT_STAMP_FORMAT = '%Y%m%d-%H%M%S'
+SEGMENT_PATTERN = re.compile(r'(\d{8}-\d{6}(?:-\d+)?)(?:\.gz)?')
+
+
+def parse_history_line(line):
+    if line.startswith('[') and '] ' in line:
+        timestamp, message = line.split('] ', 1)
+        try:
+            return datetime.datetime.strptime(f'{timestamp}]', TIMESTAMP_FORMAT), message
+        except ValueError:
+            return None, message
+    return None, line
+
+
+def format_history_line(timestamp, message):
+    return f"{timestamp.strftime(TIMESTAMP_FORMAT)} {message}\n"
+
+
+def read_lines_before(f, end=None, limit=None, since=None, block_size=64 * 1024):
+    lines, starts = [], []
+    if end is None:
+        end = f.seek(0, os.SEEK_END)
+    cursor = end
+    position = end
+    buffer = b''
+    while position > 0:
+        read_size = min(block_size, position)
+        position -= read_size
+        f.seek(position)
+        buffer = f.read(read_size) + buffer
+        line_end = position + len(buffer)
+        parts = buffer.split(b'\n')
+        buffer = parts[0]
+        complete_parts = parts[1:] if position > 0 else parts
+        for part in reversed(complete_parts):
+            line_start = line_end - len(part)
+            line_end = line_start - 1
+            line = part.decode('utf-8', errors='replace').strip()
+            if line:
+                timestamp, _ = parse_history_line(line)
+                if since and timestamp and timestamp < since:
+                    return lines[::-1], starts[::-1], cursor
+                lines.append(line)
+                starts.append(line_start)
+            cursor = line_start
+            if limit and len(lines) >= limit:
+                return lines[::-1], starts[::-1], cursor
+    return lines[::-1], starts[::-1], cursor
+
+
+def read_lines_after(f, start, limit=None):
+    lines = []
+    f.seek(start)
+    while not limit or len(lines) < limit:
+        raw_line = f.readline()
+        if not raw_line:
+            break
+        line = raw_line.decode('utf-8', errors='replace').strip()
+        if line:
+            lines.append(line)
+    return lines, f.tell()
+
+
+def first_line_timestamp(f, position):
+    f.seek(position)
+    if position:
+        f.readline()
+    line_start = f.tell()
+    while raw_line := f.readline():
+        timestamp, _ = parse_history_line(raw_line.decode('utf-8', errors='replace').strip())
+        if timestamp:
+            return line_start, timestamp
+    return line_start, None
+
+
+def find_line_at(f, timestamp):
+    low, high = 0, f.seek(0, os.SEEK_END)
+    while low < high:
+        middle = (low + high) // 2
+        _, line_timestamp = first_line_timestamp(f, middle)
+        if line_timestamp is None or line_timestamp >= timestamp:
+            high = middle
+        else:
+            low = middle + 1
+    line_start, _ = first_line_timestamp(f, low)
+    return line_start
+
+
+class TextHistory:
+    def __init__(self, history_file, durability='buffered'):
+        self.history_file = history_file
+        self.durability = durability
+        self.file = None
+        self.size = 0
+
+    async def __aenter__(self):
+        self.file = await aiofiles.open(self.history_file, mode='a', encoding='utf-8')
+        self.size = os.path.getsize(self.history_file)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.file.close()
+        self.file = None
+
+    def advance(self, lines):
+        # смещения начала записанных строк, по ним окно продолжает историю после обрезки
+        offsets = []
+        for line in lines:
+            offsets.append(self.size)
+            self.size += len(line) if line.isascii() else len(line.encode('utf-8'))
+        return offsets
+
+    async def write(self, entries):
+        lines = [format_history_line(timestamp, message) for timestamp, message in entries]
+        offsets = self.advance(lines)
+        await self.file.write(''.join(lines))
+        return offsets
+
+    async def flush(self):
+        await self.file.flush()
+        if self.durability == 'fsync':
+            await asyncio.to_thread(os.fsync, self.file.fileno())
+
+    def to_entries(self, lines):
+        return [parse_history_line(line) for line in lines]
+
+    def read_page(self, cursor=None, limit=None, since=None):
+        if not os.path.exists(self.history_file):
+            return [], [], None
+        with open(self.history_file, 'rb') as f:
+            lines, starts, offset = read_lines_before(f, cursor, limit, since)
+        return self.to_entries(lines), starts, offset or None
+
+    def tail(self, limit=None, since=None):
+        entries, _, cursor = self.read_page(None, limit, since)
+        return entries, cursor
+
+    def page_before(self, cursor, limit):
+        entries, _, cursor = self.read_page(cursor, limit)
+        return entries, cursor
+
+    def page_after(self, cursor, limit):
+        with open(self.history_file, 'rb') as f:
+            lines, offset = read_lines_after(f, cursor, limit)
+        return self.to_entries(lines), offset
+
+    def find(self, timestamp):
+        with open(self.history_file, 'rb') as f:
+            return find_line_at(f, timestamp)
+
+
+def compress_segment(segment_file):
+    temp_file = f'{segment_file}.gz.tmp'
+    with open(segment_file, 'rb') as source, gzip.open(temp_file, 'wb') as target:
+        shutil.copyfileobj(source, target)
+    os.replace(temp_file, f'{segment_file}.gz')
+    os.remove(segment_file)
+
+
+class RotatingHistory(TextHistory):
+    """Текстовая история, которая делится на сегменты по размеру или по дням.
+
+    Текущий сегмент - сам файл истории, закрытые сегменты лежат рядом как
+    chat_history.txt.20251004-215642.gz. Курсор - пара (сегмент, смещение); текущий
+    файл обозначается номером поворота, чтобы курсор оставался верным после ротации.
+    """
+
+    def __init__(self, history_file, durability='buffered', rotate_size=16 * 1024 * 1024, rotate_daily=False):
+        super().__init__(history_file, durability)
+        self.rotate_size = rotate_size
+        self.rotate_daily = rotate_daily
+        self.rotated_stamps = []
+        self.active_day = None
+        self.compress_tasks = set()
+        self.cached_segment = (None, b'')
+        # страницы читаются в потоках asyncio.to_thread, кэш распакованного сегмента у них общий
+        self.cache_lock = threading.Lock()
+
+    def segment_file(self, stamp):
+        return f'{self.history_file}.{stamp}'
+
+    def segments(self):
+        directory = os.path.dirname(self.history_file) or '.'
+        prefix = f'{os.path.basename(self.history_file)}.'
+        stamps = set()
+        for name in os.listdir(directory):
+            match = SEGMENT_PATTERN.fullmatch(name[len(prefix):]) if name.startswith(prefix) else None
+            if match:
+                stamps.add(match.group(1))
+        return sorted(stamps, key=lambda stamp: (stamp[:15], int(stamp[16:] or 0)))
+
+    def active_cursor(self, offset=None):
+        return len(self.rotated_stamps), offset
+
+    def resolve(self, segment):
+        if isinstance(segment, int):
+            return self.rotated_stamps[segment] if segment < len(self.rotated_stamps) else None
+        return segment
+
+    def open_segment(self, stamp):
+        # сегменты сжимаются в другом потоке: сначала появляется .gz, потом удаляется исходный файл,
+        # поэтому открываем файл сразу и только при его отсутствии берём сжатую копию
+        if stamp is None:
+            try:
+                return open(self.history_file, 'rb')
+            except FileNotFoundError:
+                return io.BytesIO()
+        segment_file = self.segment_file(stamp)
+        try:
+            return open(segment_file, 'rb')
+        except FileNotFoundError:
+            pass
+        with self.cache_lock:
+            cached_stamp, data = self.cached_segment
+            if cached_stamp != stamp:
+                with gzip.open(f'{segment_file}.gz', 'rb') as f:
+                    data = f.read()
+                self.cached_segment = (stamp, data)
+        return io.BytesIO(data)
+
+    def neighbour(self, stamp, step):
+        stamps = self.segments()
+        if stamp is None:
+            return stamps[-1] if step < 0 and stamps else False
+        position = stamps.index(stamp) + step
+        if position < 0:
+            return False
+        return stamps[position] if position < len(stamps) else None
+
+    def to_cursor(self, stamp, offset):
+        return self.active_cursor(offset) if stamp is None else (stamp, offset)
+
+    def read_page(self, cursor=None, limit=None, since=None):
+        segment, end = cursor or self.active_cursor()
+        stamp = self.resolve(segment)
+        lines, positions = [], []
+        while True:
+            with self.open_segment(stamp) as f:
+                segment_lines, starts, offset = read_lines_before(f, end, limit and limit - len(lines), since)
+            lines = segment_lines + lines
+            positions = [self.to_cursor(stamp, start) for start in starts] + positions
+            if offset:
+                return self.to_entries(lines), positions, self.to_cursor(stamp, offset)
+            previous = self.neighbour(stamp, -1)
+            if previous is False:
+                return self.to_entries(lines), positions, None
+            if limit and len(lines) >= limit:
+                return self.to_entries(lines), positions, (previous, None)
+            stamp, end = previous, None
+
+    def page_after(self, cursor, limit):
+        segment, start = cursor
+        stamp = self.resolve(segment)
+        lines = []
+        while True:
+            with self.open_segment(stamp) as f:
+                segment_lines, offset = read_lines_after(f, start, limit and limit - len(lines))
+            lines += segment_lines
+            following = self.neighbour(stamp, 1) if stamp is not None else False
+            if (limit and len(lines) >= limit) or following is False:
+                return self.to_entries(lines), self.to_cursor(stamp, offset)
+            stamp, start = following, 0
+
+    def find(self, timestamp):
+        for stamp in self.segments():
+            # в сегмент, закрытый позже искомого времени, попадают и все более ранние сообщения
+            if datetime.datetime.strptime(stamp[:15], SEGMENT_STAMP_FORMAT) >= timestamp:
+                with self.open_segment(stamp) as f:
+                    offset = find_line_at(f, timestamp)
+                    if offset < f.seek(0, os.SEEK_END):
+                        return stamp, offset
+        with self.open_segment(None) as f:
+            return self.active_cursor(find_line_at(f, timestamp))
+
+    async def __aenter__(self):
+        await super().__aenter__()
+        with open(self.history_file, 'rb') as f:
+            _, first_timestamp = first_line_timestamp(f, 0)
+        self.active_day = first_timestamp and first_timestamp.date()
+        for stamp in self.segments():
+            if os.path.exists(self.segment_file(stamp)):
+                # сегмент, который не успели сжать до закрытия программы
+                self.compress_in_background(self.segment_file(stamp))
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await asyncio.gather(*self.compress_tasks, return_exceptions=True)
+        await super().__aexit__(*exc_info)
+
+    def compress_in_background(self, segment_file):
+        task = asyncio.create_task(asyncio.to_thread(compress_segment, segment_file))
+        self.compress_tasks.add(task)
+        task.add_done_callback(self.compress_tasks.discard)
+
+    def should_rotate(self, timestamp):
+        if not self.size:
+            return False
+        if self.rotate_daily and self.active_day and timestamp.date() != self.active_day:
+            return True
+        return bool(self.rotate_size) and self.size >= self.rotate_size
+
+    async def rotate(self):
+        await self.flush()
+        await self.file.close()
+        stamp = datetime.datetime.now().strftime(SEGMENT_STAMP_FORMAT)
+        existing = set(self.segments())
+        unique_stamp, number = stamp, 1
+        while unique_stamp in existing:
+            unique_stamp, number = f'{stamp}-{number}', number + 1
+        os.replace(self.history_file, self.segment_file(unique_stamp))
+        self.rotated_stamps.append(unique_stamp)
+        self.file = await aiofiles.open(self.history_file, mode='a', encoding='utf-8')
+        self.size = 0
+        self.active_day = None
+        logger.info(f"🗜️ История: закрыт сегмент {self.segment_file(unique_stamp)}")
+        self.compress_in_background(self.segment_file(unique_stamp))
+
+    async def write(self, entries):
+        if self.should_rotate(entries[0][0]):
+            await self.rotate()
+        lines = [format_history_line(timestamp, message) for timestamp, message in entries]
+        offsets = self.advance(lines)
+        await self.file.write(''.join(lines))
+        self.active_day = self.active_day or entries[0][0].date()
+        return [self.active_cursor(offset) for offset in offsets]
+
+
+class SqliteHistory:
+    def __init__(self, history_file, durability='buffered'):
+        self.history_file = history_file
+        self.durability = durability
+        self.connection = None
+        self.schema_ready = False
+
+    def connect(self):
+        import sqlite3
+        connection = sqlite3.connect(self.history_file, check_same_thread=False)
+        if not self.schema_ready:
+            # схема и режим WAL сохраняются в самой базе, соединениям для чтения их повторять не нужно
+            self.create_schema(connection)
+        return connection
+
+    def create_schema(self, connection):
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute(
+            'CREATE TABLE IF NOT EXISTS messages ('
+            'id INTEGER PRIMARY KEY, created_at REAL NOT NULL, message TEXT NOT NULL)'
+        )
+        connection.execute('CREATE INDEX IF NOT EXISTS messages_created_at ON messages (created_at)')
+        connection.commit()
+        self.schema_ready = True
+
+    def connect_writer(self):
+        connection = self.connect()
+        connection.execute(f"PRAGMA synchronous={'FULL' if self.durability == 'fsync' else 'NORMAL'}")
+        return connection
+
+    async def __aenter__(self):
+        self.connection = await asyncio.to_thread(self.connect_writer)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await asyncio.to_thread(self.disconnect)
+
+    def disconnect(self):
+        self.connection.commit()
+        self.connection.close()
+        self.connection = None
+
+    def insert(self, connection, entries):
+        connection.executemany(
+            'INSERT INTO messages (created_at, message) VALUES (?, ?)',
+            [(timestamp.timestamp(), message) for timestamp, message in entries],
+        )
+        # пишет одно соединение, поэтому пачка получает подряд идущие id, последний из них - last_insert_rowid()
+        last_id = connection.execute('SELECT last_insert_rowid()').fetchone()[0]
+        return list(range(last_id - len(entries) + 1, last_id + 1))
+
+    async def write(self, entries):
+        return await asyncio.to_thread(self.insert, self.connection, entries)
+
+    async def flush(self):
+        await asyncio.to_thread(self.connection.commit)
+
+    def to_entries(self, rows):
+        return [(datetime.datetime.fromtimestamp(created_at), message) for _, created_at, message in rows]
+
+    def read_page(self, cursor=None, limit=None, since=None):
+        row_id = MAX_ROW_ID if cursor is None else cursor
+        query = 'SELECT id, created_at, message FROM messages WHERE id < ?'
+        params = [row_id]
+        if since:
+            query += ' AND created_at >= ?'
+            params.append(since.timestamp())
+        query += ' ORDER BY id DESC LIMIT ?'
+        params.append(limit or -1)
+        with closing(self.connect()) as connection:
+            rows = connection.execute(query, params).fetchall()[::-1]
+            if not rows:
+                return [], [], None
+            has_older = connection.execute(
+                'SELECT EXISTS(SELECT 1 FROM messages WHERE id < ?)', (rows[0][0],)
+            ).fetchone()[0]
+        return self.to_entries(rows), [row[0] for row in rows], rows[0][0] if has_older else None
+
+    def tail(self, limit=None, since=None):
+        entries, _, cursor = self.read_page(None, limit, since)
+        return entries, cursor
+
+    def page_before(self, cursor, limit):
+        entries, _, cursor = self.read_page(cursor, limit)
+        return entries, cursor
+
+    def page_after(self, cursor, limit):
+        with closing(self.connect()) as connection:
+            rows = connection.execute(
+                'SELECT id, created_at, message FROM messages WHERE id >= ? ORDER BY id LIMIT ?',
+                (cursor, limit or -1),
+            ).fetchall()
+        next_cursor = rows[-1][0] + 1 if rows else cursor
+        return self.to_entries(rows), next_cursor
+
+    def find(self, timestamp):
+        with closing(self.connect()) as connection:
+            row = connection.execute(
+                'SELECT id FROM messages WHERE created_at >= ? ORDER BY created_at LIMIT 1',
+                (timestamp.timestamp(),),
+            ).fetchone()
+            if row:
+                return row[0]
+            return connection.execute('SELECT COALESCE(MAX(id), 0) + 1 FROM messages').fetchone()[0]
+
+
+HISTORY_BACKENDS = {
+    'text': TextHistory,
+    'rotating': RotatingHistory,
+    'sqlite': SqliteHistory,
+}
+
+
+def open_history(backend, history_file, durability='buffered', **options):
+    if backend not in HISTORY_BACKENDS:
+        raise ValueError(f"Неизвестное хранилище истории: {backend}, доступны {', '.join(HISTORY_BACKENDS)}")
+    return HISTORY_BACKENDS[backend](history_file, durability, **options)
+
+
+class HistoryPager:
+    def __init__(self, history, cursor, page_size=200):
+        self.history = history
+        self.cursor = cursor
+        self.page_size = page_size
+        # курсор двигают и прокрутка, и переход к результатам поиска
+        self.lock = asyncio.Lock()
+        # сообщения окна в порядке строк: после обрезки окна история продолжается от верхнего из них
+        self.shown = deque()
+        self.resume_from = None
+
+    @property
+    def has_more(self):
+        return self.cursor is not None or self.resume_from is not None
+
+    def show(self, messages):
+        self.shown.extend(messages)
+
+    def trim(self, count):
+        for _ in range(min(count, len(self.shown))):
+            self.shown.popleft()
+        self.cursor = None
+        self.resume_from = self.shown[0] if self.shown else None
+
+    async def load_older(self):
+        if self.resume_from is not None:
+            if self.resume_from.history_position is None:
+                # верхнее сообщение окна ещё не сброшено на диск, старшие строки подгрузим позже
+                return []
+            self.cursor, self.resume_from = self.resume_from.history_position, None
+        if self.cursor is None:
+            return []
+        entries, positions, self.cursor = await asyncio.to_thread(
+            self.history.read_page, self.cursor, self.page_size
+        )
+        messages = [
+            ChatMessage.from_history(timestamp, line, position)
+            for (timestamp, line), position in zip(entries, positions)
+        ]
+        self.shown.extendleft(reversed(messages))
+        return messages
+
+
+def import_text_history(text_file, history):
+    with closing(history.connect()) as connection:
+        if connection.execute('SELECT EXISTS(SELECT 1 FROM messages)').fetchone()[0]:
+            logger.warning(f"Хранилище {history.history_file} уже заполнено, импорт пропущен")
+            return 0
+
+        imported = 0
+        last_timestamp = datetime.datetime.fromtimestamp(0)
+        entries = []
+        with open(text_file, 'r', encoding='utf-8', errors='replace') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                timestamp, message = parse_history_line(line)
+                last_timestamp = timestamp or last_timestamp
+                entries.append((last_timestamp, message))
+                if len(entries) >= IMPORT_BATCH_SIZE:
+                    history.insert(connection, entries)
+                    imported += len(entries)
+                    entries = []
+        history.insert(connection, entries)
+        imported += len(entries)
+        connection.commit()
+    logger.info(f"📥 Импортировано {imported} сообщений из {text_file} в {history.history_file}")
+    return imported
+
+
+def main():
+    import argparse
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description='Обслуживание истории чата')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    import_parser = subparsers.add_parser('import', help='импорт chat_history.txt в SQLite')
+    import_parser.add_argument('text_file')
+    import_parser.add_argument('sqlite_file')
+    args = parser.parse_args()
+
+    if args.command == 'import':
+        import_text_history(args.text_file, SqliteHistory(args.sqlite_file))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+import os
+import time
+
+
+class Keepalive:
+    # ping уходит только после тишины на соединении отправки, а по времени ответа на него
+    # считаются сглаженный RTT и его разброс, как для таймаута повторной передачи в TCP (RFC 6298)
+    def __init__(self, idle_interval=10, initial_timeout=15, min_rto=2, max_rto=60):
+        self.idle_interval = idle_interval
+        self.initial_timeout = initial_timeout
+        self.min_rto = min_rto
+        self.max_rto = max_rto
+        self.srtt = None
+        self.rttvar = None
+        self.ping_sent_at = None
+        self.last_activity = time.monotonic()
+
+    def touch(self):
+        self.last_activity = time.monotonic()
+
+    def idle_time(self):
+        return time.monotonic() - self.last_activity
+
+    def ping_sent(self):
+        self.touch()
+        # на неотвеченный ping время считаем от первого, чтобы не занизить RTT
+        if self.ping_sent_at is None:
+            self.ping_sent_at = self.last_activity
+
+    def response_received(self):
+        self.touch()
+        if self.ping_sent_at is None:
+            return None
+        rtt = self.last_activity - self.ping_sent_at
+        self.ping_sent_at = None
+        self.observe(rtt)
+        return rtt
+
+    def observe(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+
+    def timeout(self):
+        # initial_timeout=0 (CHAT_WRITE_TIMEOUT=0) выключает watchdog и после замера RTT
+        if self.srtt is None or not self.initial_timeout:
+            return self.initial_timeout
+        # сервер может молчать idle_interval до нашего ping и ещё RTO до ответа на него
+        rto = min(max(self.srtt + 4 * self.rttvar, self.min_rto), self.max_rto)
+        return self.idle_interval + rto
+
+
+def keepalive_from_env(initial_timeout):
+    idle_interval = float(os.environ.get('CHAT_PING_IDLE', '10'))
+    return Keepalive(idle_interval, initial_timeout)
@@ -0,0 +1,121 @@
+import asyncio
+import logging
+from collections import deque
+
+import capture
+import metrics
+
+
+logger = logging.getLogger('line_reader')
+
+MAX_LINE_LENGTH = 64 * 1024
+READ_SIZE = 64 * 1024
+
+
+class LineProtocol(asyncio.BufferedProtocol):
+    # сокет пишет прямо в наш bytearray, строки режутся без промежуточных буферов StreamReader
+    # и отдаются пачкой на каждое чтение, а не по одной через await readline()
+    def __init__(self, max_line_length=MAX_LINE_LENGTH, high_water=10000):
+        self.max_line_length = max_line_length
+        self.buffer = bytearray(max_line_length + READ_SIZE)
+        self.view = memoryview(self.buffer)
+        self.start = 0
+        self.scanned = 0
+        self.end = 0
+        self.discarding = False
+        self.batches = deque()
+        self.pending_lines = 0
+        self.high_water = high_water
+        self.transport = None
+        self.connection_id = 0
+        self.paused = False
+        self.waiter = None
+        self.closed_error = None
+        self.overlong_counter = metrics.registry.counter('chat_overlong_lines')
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.connection_id = capture.recorder.new_connection()
+
+    def get_buffer(self, sizehint):
+        if len(self.buffer) - self.end < READ_SIZE:
+            # недочитанная строка короче max_line_length, после сдвига в начало места хватит
+            unconsumed = self.end - self.start
+            self.buffer[:unconsumed] = bytes(self.view[self.start:self.end])
+            self.scanned -= self.start
+            self.start, self.end = 0, unconsumed
+        return self.view[self.end:]
+
+    def buffer_updated(self, nbytes):
+        if capture.recorder.enabled:
+            # пишем байты в момент прихода, а не когда их разберёт потребитель, чтобы паузы в записи были сетевыми
+            capture.recorder.record(capture.READ, bytes(self.view[self.end:self.end + nbytes]), self.connection_id)
+        self.end += nbytes
+        batch = []
+        buffer, view, position = self.buffer, self.view, self.start
+        newline = buffer.find(b'\n', self.scanned, self.end)
+        while newline != -1:
+            if self.discarding:
+                self.discarding = False
+            elif newline + 1 - position > self.max_line_length:
+                # длинная строка может прийти целиком за одно чтение, проверяем каждую
+                self.skip_overlong()
+            else:
+                batch.append(bytes(view[position:newline + 1]))
+            position = newline + 1
+            newline = buffer.find(b'\n', position, self.end)
+        # в хвосте после последней строки перевода строки нет, в следующий раз ищем за ним
+        self.start, self.scanned = position, self.end
+
+        if self.end - self.start > self.max_line_length:
+            if not self.discarding:
+                self.skip_overlong()
+            self.discarding = True
+            self.start = self.scanned = self.end
+        if self.start == self.end:
+            self.start = self.scanned = self.end = 0
+        if batch:
+            self.deliver(batch)
+
+    def skip_overlong(self):
+        logger.warning(f"Строка длиннее {self.max_line_length} байт пропущена")
+        self.overlong_counter.inc()
+
+    def deliver(self, batch):
+        self.batches.append(batch)
+        self.pending_lines += len(batch)
+        if not self.paused and self.pending_lines > self.high_water:
+            self.paused = True
+            self.transport.pause_reading()
+        self.wake()
+
+    def eof_received(self):
+        return False
+
+    def connection_lost(self, exc):
+        if self.end > self.start and not self.discarding:
+            # последняя строка без перевода строки, как её отдал бы readline()
+            self.deliver([bytes(self.view[self.start:self.end])])
+        self.closed_error = exc or ConnectionError("Сервер закрыл соединение для чтения")
+        self.wake()
+
+    def wake(self):
+        if self.waiter and not self.waiter.done():
+            self.waiter.set_result(None)
+
+    async def read_batch(self):
+        while not self.batches:
+            if self.closed_error:
+                raise self.closed_error
+            self.waiter = asyncio.get_running_loop().create_future()
+            await self.waiter
+        batch = self.batches.popleft()
+        self.pending_lines -= len(batch)
+        if self.paused and self.pending_lines <= self.high_water // 2:
+            self.paused = False
+            self.transport.resume_reading()
+        return batch
+
+
+async def open_line_connection(host, port, max_line_length=MAX_LINE_LENGTH):
+    return await asyncio.get_running_loop().create_connection(lambda: LineProtocol(max_line_length), host, port)
@@ -0,0 +1,175 @@
+import asyncio
+import logging
+import os
+import time
+
+import anyio
+
+
+logger = logging.getLogger('metrics')
+
+
+class Counter:
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, value=1):
+        self.value += value
+
+    def samples(self, name):
+        return [(f'{name}_total', self.value)]
+
+
+class Summary:
+    def __init__(self):
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def samples(self, name):
+        return [(f'{name}_count', self.count), (f'{name}_sum', self.sum), (f'{name}_max', self.max)]
+
+
+class Gauge:
+    def __init__(self, getter):
+        self.getter = getter
+
+    def samples(self, name):
+        return [(name, self.getter())]
+
+
+def escape_label(value):
+    # в метках есть ники аккаунтов, а в них могут оказаться кавычки и обратные слэши
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Registry:
+    enabled = True
+
+    def __init__(self):
+        self.metrics = {}
+        self.started_at = time.monotonic()
+
+    def get_or_create(self, factory, name, labels):
+        key = (name, tuple(sorted(labels.items())))
+        if key not in self.metrics:
+            self.metrics[key] = factory()
+        return self.metrics[key]
+
+    def counter(self, name, **labels):
+        return self.get_or_create(Counter, name, labels)
+
+    def summary(self, name, **labels):
+        return self.get_or_create(Summary, name, labels)
+
+    def gauge(self, name, getter, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        # очередь с тем же именем могла быть создана заново - показываем последнюю
+        self.metrics[key] = Gauge(getter)
+        return self.metrics[key]
+
+    def render(self):
+        lines = [f'chat_uptime_seconds {time.monotonic() - self.started_at:.3f}']
+        for (name, labels), metric in sorted(self.metrics.items(), key=lambda item: item[0]):
+            label_text = ','.join(f'{key}="{escape_label(value)}"' for key, value in labels)
+            label_text = f'{{{label_text}}}' if label_text else ''
+            for sample_name, value in metric.samples(name):
+                lines.append(f'{sample_name}{label_text} {value:g}')
+        return '\n'.join(lines) + '\n'
+
+
+class NullMetric:
+    def inc(self, value=1):
+        pass
+
+    def observe(self, value):
+        pass
+
+
+class NullRegistry:
+    enabled = False
+    null_metric = NullMetric()
+
+    def counter(self, name, **labels):
+        return self.null_metric
+
+    def summary(self, name, **labels):
+        return self.null_metric
+
+    def gauge(self, name, getter, **labels):
+        return self.null_metric
+
+    def render(self):
+        return ''
+
+
+# Пока метрики не включены, все счётчики - один общий объект с пустыми методами
+registry = NullRegistry()
+
+
+def enable_from_env():
+    global registry
+    if os.environ.get('CHAT_METRICS_PORT') or os.environ.get('CHAT_METRICS_FILE'):
+        if not registry.enabled:
+            registry = Registry()
+    return registry.enabled
+
+
+async def handle_scrape(reader, writer):
+    try:
+        request_line = await reader.readline()
+        while (await reader.readline()).strip():
+            pass
+        if request_line.split(b' ')[1:2] == [b'/metrics']:
+            status, body = '200 OK', registry.render().encode()
+        else:
+            status, body = '404 Not Found', b'not found\n'
+        writer.write(
+            f'HTTP/1.0 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n'
+            f'Content-Length: {len(body)}\r\n\r\n'.encode() + body
+        )
+        await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+async def serve_metrics(host, port):
+    server = await asyncio.start_server(handle_scrape, host, port)
+    logger.info(f"📊 Метрики: http://{host}:{port}/metrics")
+    async with server:
+        await server.serve_forever()
+
+
+def write_stats_file(stats_file, text):
+    temp_file = f'{stats_file}.tmp'
+    with open(temp_file, 'w', encoding='utf-8') as f:
+        f.write(text)
+    os.replace(temp_file, stats_file)
+
+
+async def write_stats_periodically(stats_file, interval):
+    logger.info(f"📊 Метрики пишутся в {stats_file} каждые {interval:g}с")
+    while True:
+        await asyncio.sleep(interval)
+        await asyncio.to_thread(write_stats_file, stats_file, registry.render())
+
+
+async def export_metrics():
+    if not registry.enabled:
+        return
+    port = os.environ.get('CHAT_METRICS_PORT')
+    stats_file = os.environ.get('CHAT_METRICS_FILE')
+    async with anyio.create_task_group() as export_group:
+        if port:
+            export_group.start_soon(serve_metrics, os.environ.get('CHAT_METRICS_HOST', '127.0.0.1'), int(port))
+        if stats_file:
+            interval = float(os.environ.get('CHAT_METRICS_INTERVAL', '10'))
+            export_group.start_soon(write_stats_periodically, stats_file, interval)
@@ -0,0 +1,202 @@
+import argparse
+import asyncio
+import logging
+import os
+import signal
+import stat
+import sys
+import threading
+from functools import partial
+
+import anyio
+from exceptiongroup import BaseExceptionGroup
+
+import capture
+import metrics
+from bus import CHAT_TOPIC, SYSTEM_TOPIC, MessageBus
+from chat_events import NicknameReceived
+from chat_functions import InvalidToken, supervise
+from chat_prototype import (Heartbeat, handle_authorisation, history_from_env, prepare_environment,
+                            read_engine_from_env, read_with_watchdog, replay_filter_from_env, save_messages,
+                            search_index_from_env, send_with_watchdog, stop_saving)
+from outbox import Outbox
+from queues import drain_queue, queue_from_env
+from token_store import load_token_store
+
+
+logger = logging.getLogger('multi_account')
+
+
+class AccountSession:
+    def __init__(self, account, inbox_size=100):
+        self.account_hash = account['account_hash']
+        self.nickname = account.get('nickname') or self.account_hash[:8]
+        self.sending_queue = queue_from_env('sending', 1000, 'block', account=self.nickname)
+        self.inbox = queue_from_env('inbox', inbox_size, 'drop_oldest', account=self.nickname)
+        self.heartbeat = Heartbeat()
+        # один outbox на всё время работы аккаунта: неподтверждённые сообщения досылаются после переподключения
+        self.outbox = Outbox(None)
+
+
+async def print_messages(messages_queue, max_batch=1000):
+    while True:
+        messages = drain_queue(messages_queue, await messages_queue.get(), max_batch)
+        sys.stdout.write(''.join(f'{message.line}\n' for message in messages))
+        sys.stdout.flush()
+
+
+async def watch_mentions(session):
+    mention = f'@{session.nickname}'
+    while True:
+        message = await session.inbox.get()
+        if mention in message.text:
+            logger.info(f"📣 {session.nickname} упомянут: {message}")
+
+
+def read_stdin_in_thread(loop, lines):
+    try:
+        for line in iter(sys.stdin.readline, ''):
+            loop.call_soon_threadsafe(lines.put_nowait, line)
+        loop.call_soon_threadsafe(lines.put_nowait, '')
+    except RuntimeError:
+        # цикл событий уже закрыт, программа завершается
+        pass
+
+
+async def stdin_lines():
+    loop = asyncio.get_running_loop()
+    mode = os.fstat(sys.stdin.fileno()).st_mode
+    if sys.platform != 'win32' and (stat.S_ISFIFO(mode) or stat.S_ISSOCK(mode) or sys.stdin.isatty()):
+        # pipe или терминал читаем транспортом цикла событий, такое чтение отменяется при SIGTERM и Ctrl+C;
+        # терминал открываем заново, чтобы неблокирующий режим не достался stdout на том же терминале
+        pipe = open(os.ttyname(sys.stdin.fileno()), 'rb', buffering=0) if sys.stdin.isatty() else sys.stdin
+        reader = asyncio.StreamReader()
+        transport, _ = await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), pipe)
+        try:
+            while line := await reader.readline():
+                yield line.decode('utf-8', errors='replace')
+        finally:
+            transport.close()
+        return
+
+    # обычный файл и Windows: поток-демон, в отличие от default executor, не держит завершение asyncio.run
+    lines = asyncio.Queue()
+    threading.Thread(target=read_stdin_in_thread, args=(loop, lines), daemon=True).start()
+    while line := await lines.get():
+        yield line
+
+
+async def route_stdin(sessions):
+    async for line in stdin_lines():
+        # ники уточняются после авторизации, поэтому собираем словарь заново
+        by_nickname = {session.nickname: session for session in sessions}
+        nickname, _, message = line.strip().partition(': ')
+        if nickname in by_nickname and message:
+            await by_nickname[nickname].sending_queue.put(message)
+        elif line.strip():
+            logger.warning(f"Строка должна иметь вид «ник: сообщение», ник из {', '.join(by_nickname)}")
+
+
+async def log_status_updates(status_updates_queue):
+    while True:
+        update = await status_updates_queue.get()
+        if isinstance(update, NicknameReceived):
+            logger.info(f"👤 Авторизован {update.nickname}")
+
+
+async def serve_session(session, host, port, save_queue, status_updates_queue, connect_limiter, timeout):
+    authorised_sessions = []
+    try:
+        # ограничиваем одновременные подключения, чтобы не устроить серверу лавину при запуске
+        async with connect_limiter:
+            authorised_sessions.append(await handle_authorisation(
+                host, port, session.account_hash, status_updates_queue, save_queue, session.heartbeat,
+            ))
+    except (ConnectionError, OSError, asyncio.TimeoutError) as e:
+        logger.warning(f"🔄 {session.nickname}: не удалось авторизоваться ({e}), продолжим с переподключением")
+    session.nickname = authorised_sessions[0][2]['nickname'] if authorised_sessions else session.nickname
+
+    await supervise(
+        send_with_watchdog, host, port, session.account_hash, session.sending_queue, save_queue,
+        status_updates_queue, session.heartbeat, timeout, authorised_sessions, session.outbox,
+        name=f'отправка {session.nickname}',
+    )
+
+
+async def run_session(session, *args):
+    # ошибка одного аккаунта, в том числе после переподключения, не должна останавливать остальные
+    try:
+        await serve_session(session, *args)
+    except Exception as e:
+        if isinstance(e, InvalidToken) or isinstance(e, BaseExceptionGroup) and e.subgroup(InvalidToken):
+            logger.error(f"❌ {session.nickname}: токен не принят сервером, аккаунт отключён")
+        else:
+            logger.error(f"❌ {session.nickname}: аккаунт отключён из-за ошибки: {e!r}")
+
+
+async def run_accounts(accounts, connect_limit):
+    host = os.environ.get('CHAT_HOST', 'minechat.dvmn.org')
+    read_port = int(os.environ.get('LISTEN_CHAT_PORT', '5000'))
+    send_port = int(os.environ.get('MESSAGE_CHAT_PORT', '5050'))
+    read_timeout = float(os.environ.get('CHAT_READ_TIMEOUT', '300'))
+    write_timeout = float(os.environ.get('CHAT_WRITE_TIMEOUT', '15'))
+    read_engine = read_engine_from_env()
+    metrics.enable_from_env()
+    capture.enable_from_env()
+
+    printed_queue = queue_from_env('printed', 10000, 'drop_oldest')
+    status_updates_queue = queue_from_env('status', 100, 'drop_oldest')
+    save_queue = queue_from_env('save', 10000, 'block')
+    sessions = [AccountSession(account) for account in accounts]
+    bus = MessageBus()
+    bus.subscribe(save_queue, CHAT_TOPIC, SYSTEM_TOPIC)
+    bus.subscribe(printed_queue, CHAT_TOPIC)
+    for session in sessions:
+        bus.subscribe(session.inbox, CHAT_TOPIC)
+    connect_limiter = asyncio.Semaphore(connect_limit)
+
+    history, flush_size, flush_interval = history_from_env()
+    replay_filter = await replay_filter_from_env(history)
+    save_task = asyncio.create_task(save_messages(history, save_queue, flush_size, flush_interval,
+                                                  search_index_from_env()))
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+    logger.info(f"👥 Запускаем {len(sessions)} аккаунтов на одном соединении для чтения")
+    try:
+        async with anyio.create_task_group() as accounts_group:
+            accounts_group.start_soon(partial(
+                supervise, read_with_watchdog, host, read_port, bus, status_updates_queue, Heartbeat(), read_timeout,
+                replay_filter, read_engine=read_engine, name='чтение',
+            ))
+            accounts_group.start_soon(print_messages, printed_queue)
+            accounts_group.start_soon(log_status_updates, status_updates_queue)
+            accounts_group.start_soon(route_stdin, sessions)
+            accounts_group.start_soon(metrics.export_metrics)
+            for session in sessions:
+                accounts_group.start_soon(watch_mentions, session)
+                accounts_group.start_soon(run_session, session, host, send_port, save_queue,
+                                          status_updates_queue, connect_limiter, write_timeout)
+    finally:
+        await stop_saving(save_task, save_queue)
+        capture.close()
+
+
+def main():
+    prepare_environment()
+    parser = argparse.ArgumentParser(description='Несколько аккаунтов чата в одном процессе')
+    parser.add_argument('--accounts', default=os.environ.get('CHAT_ACCOUNTS', 'chat_accounts.json'),
+                        help='файл с токенами аккаунтов')
+    parser.add_argument('--connect-limit', type=int, default=int(os.environ.get('CHAT_CONNECT_LIMIT', '10')),
+                        help='сколько аккаунтов подключается к серверу одновременно')
+    args = parser.parse_args()
+
+    accounts = load_token_store(args.accounts)
+    if not accounts:
+        sys.exit(f"❌ В {args.accounts} нет токенов. Зарегистрируйте аккаунты через registration.py.")
+    try:
+        asyncio.run(run_accounts(accounts, args.connect_limit))
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        pass
+
+
+if __name__ == '__main__':
+    main()
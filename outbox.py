@@ -0,0 +1,88 @@
+import asyncio
+import json
+import logging
+import os
+from collections import deque
+
+import aiofiles
+
+
+logger = logging.getLogger('outbox')
+
+
+class Outbox:
+    # durability='flush' отдаёт записи ОС: они переживают падение программы, но не отключение питания;
+    # 'fsync' дожидается записи на диск при каждом добавлении и подтверждении
+    def __init__(self, journal_file, durability='flush'):
+        self.journal_file = journal_file
+        self.durability = durability
+        self.pending = deque()
+        self.next_id = 1
+        self.file = None
+
+    def load(self):
+        if not self.journal_file:
+            return self
+        if os.path.exists(self.journal_file):
+            with open(self.journal_file, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # недописанная при падении строка
+                        continue
+                    if 'ack' in record:
+                        while self.pending and self.pending[0][0] <= record['ack']:
+                            self.pending.popleft()
+                    else:
+                        self.pending.append((record['id'], record['message']))
+                        self.next_id = record['id'] + 1
+
+        with open(self.journal_file, 'w', encoding='utf-8') as f:
+            for message_id, message in self.pending:
+                f.write(json.dumps({'id': message_id, 'message': message}, ensure_ascii=False) + '\n')
+            if self.durability == 'fsync':
+                f.flush()
+                os.fsync(f.fileno())
+        if self.pending:
+            logger.info(f"📮 В журнале отправки {len(self.pending)} неотправленных сообщений")
+        return self
+
+    async def __aenter__(self):
+        if self.journal_file:
+            self.file = await aiofiles.open(self.journal_file, mode='a', encoding='utf-8')
+        return self
+
+    async def __aexit__(self, *exc_info):
+        if self.file:
+            await self.file.close()
+            self.file = None
+
+    async def write_records(self, records):
+        if not self.file:
+            return
+        await self.file.write(''.join(json.dumps(record, ensure_ascii=False) + '\n' for record in records))
+        await self.sync()
+
+    async def sync(self):
+        await self.file.flush()
+        if self.durability == 'fsync':
+            await asyncio.to_thread(os.fsync, self.file.fileno())
+
+    async def add(self, messages):
+        records = []
+        for message in messages:
+            records.append({'id': self.next_id, 'message': message})
+            self.pending.append((self.next_id, message))
+            self.next_id += 1
+        await self.write_records(records)
+
+    async def acknowledge(self, last_id):
+        while self.pending and self.pending[0][0] <= last_id:
+            self.pending.popleft()
+        if self.pending:
+            await self.write_records([{'ack': last_id}])
+        elif self.file:
+            # всё отправлено - журнал можно начать заново
+            await self.file.truncate(0)
+            await self.sync()
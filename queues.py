@@ -0,0 +1,91 @@
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+
+import metrics
+
+
+logger = logging.getLogger('queues')
+
+OVERFLOW_POLICIES = ('block', 'drop_oldest', 'drop_newest', 'coalesce')
+
+
+class OverflowQueue(asyncio.Queue):
+    def __init__(self, name, maxsize=0, policy='block', coalesce_key=None, **labels):
+        if policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"Неизвестная политика переполнения очереди {name}: {policy}")
+        # время ожидания в очереди считаем, только если метрики включены
+        self.put_times = deque() if metrics.registry.enabled else None
+        super().__init__(maxsize)
+        self.name = name
+        self.policy = policy
+        self.coalesce_key = coalesce_key
+        self.overflows = 0
+        # labels различают одноимённые очереди разных аккаунтов в одном процессе
+        self.overflow_counter = metrics.registry.counter('chat_queue_overflows', queue=name, **labels)
+        self.wait_summary = metrics.registry.summary('chat_queue_wait_seconds', queue=name, **labels)
+        metrics.registry.gauge('chat_queue_depth', self.qsize, queue=name, **labels)
+
+    def _put(self, item):
+        super()._put(item)
+        if self.put_times is not None:
+            self.put_times.append(time.monotonic())
+
+    def _get(self):
+        if self.put_times:
+            self.wait_summary.observe(time.monotonic() - self.put_times.popleft())
+        return super()._get()
+
+    def record_overflow(self):
+        self.overflows += 1
+        self.overflow_counter.inc()
+        if self.overflows & (self.overflows - 1) == 0:
+            logger.warning(
+                f"📦 Очередь {self.name} переполнена ({self.maxsize}), политика {self.policy}: "
+                f"{self.overflows} переполнений"
+            )
+
+    def coalesce(self, item):
+        key = self.coalesce_key(item)
+        for index, queued_item in enumerate(self._queue):
+            if self.coalesce_key(queued_item) == key:
+                self._queue[index] = item
+                return True
+        return False
+
+    async def put(self, item):
+        if self.policy == 'block':
+            if self.full():
+                self.record_overflow()
+            return await super().put(item)
+        return self.put_nowait(item)
+
+    def put_nowait(self, item):
+        if self.policy == 'coalesce' and self.coalesce_key and self.coalesce(item):
+            return
+        if not self.full():
+            return super().put_nowait(item)
+
+        self.record_overflow()
+        if self.policy == 'drop_newest':
+            return
+        if self.policy in ('drop_oldest', 'coalesce'):
+            self.get_nowait()
+            self.task_done()
+        return super().put_nowait(item)
+
+
+def drain_queue(queue, first_item, limit):
+    items = [first_item]
+    while len(items) < limit and not queue.empty():
+        items.append(queue.get_nowait())
+    return items
+
+
+def queue_from_env(name, maxsize, policy, coalesce_key=None, **labels):
+    prefix = f"CHAT_{name.upper()}_QUEUE"
+    maxsize = int(os.environ.get(f"{prefix}_SIZE", str(maxsize)))
+    policy = os.environ.get(f"{prefix}_POLICY", policy)
+    return OverflowQueue(name, maxsize, policy, coalesce_key, **labels)
@@ -1,192 +1,365 @@
-import tkinter as tk
-from tkinter import ttk, messagebox, scrolledtext
 import asyncio
-import aiofiles
 import os
 import logging
+import random
+import sys
+from contextlib import suppress
 from datetime import datetime
-from dotenv import load_dotenv
-import threading
-import re
 
-from chat_functions import open_connection
+import anyio
 
+from chat_functions import RECONNECT_ERRORS, open_connection, register
+from token_store import load_token_store, save_token_store
 
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-logger = logging.getLogger('register')
-load_dotenv()
-
-
-async def register(reader, writer, nickname):
-    await reader.readline()
-    writer.write(b'\n')
-    await writer.drain()
-    await reader.readline()
-    writer.write((nickname + '\n').encode())
-    await writer.drain()
-    account_data = await reader.readline()
-    import json
-    account_info = json.loads(account_data.decode().strip())
-    return account_info
-
-
-class RegistrationApp:
-    def __init__(self, root):
-        self.root = root
-        self.root.title("Регистрация в чате Майнкрафтера")
-        self.root.geometry("600x500")
-        self.root.resizable(False, False)
-        self.registration_in_progress = False
-        self.root.protocol("WM_DELETE_WINDOW", self.on_closing)
-        self.center_window()
-        self.setup_ui()
-
-
-    def center_window(self):
-        self.root.update_idletasks()
-        width = self.root.winfo_width()
-        height = self.root.winfo_height()
-        x = (self.root.winfo_screenwidth() // 2) - (width // 2)
-        y = (self.root.winfo_screenheight() // 2) - (height // 2)
-        self.root.geometry(f'{width}x{height}+{x}+{y}')
-
-
-    def on_closing(self):
-        if self.registration_in_progress:
-            if not messagebox.askokcancel("Выход", "Регистрация еще не завершена. Вы уверены, что хотите выйти?"):
-                return
-        self.root.destroy()
-
-
-    def setup_ui(self):
-        main_frame = ttk.Frame(self.root, padding="20")
-        main_frame.pack(fill=tk.BOTH, expand=True)
-
-        title_label = ttk.Label(main_frame, text="🎮 Регистрация в чате Майнкрафтера", font=("Arial", 16, "bold"))
-        title_label.pack(pady=(0, 20))
-
-        input_frame = ttk.LabelFrame(main_frame, text="Данные для регистрации", padding="15")
-        input_frame.pack(fill=tk.X, pady=10)
-
-        ttk.Label(input_frame, text="Выберите имя пользователя:", font=("Arial", 10)).pack(anchor=tk.W)
-        self.nickname_var = tk.StringVar()
-        nickname_entry = ttk.Entry(input_frame, textvariable=self.nickname_var, font=("Arial", 12), width=40)
-        nickname_entry.pack(fill=tk.X, pady=(5, 10))
-        nickname_entry.focus()
-
-        self.register_button = ttk.Button(input_frame, text="🚀 Зарегистрироваться", command=self.start_registration)
-        self.register_button.pack(pady=15)
 
-        self.progress = ttk.Progressbar(input_frame, mode='indeterminate', length=500)
-        self.progress.pack(fill=tk.X, pady=5)
-
-        log_frame = ttk.LabelFrame(main_frame, text="Журнал регистрации", padding="10")
-        log_frame.pack(fill=tk.BOTH, expand=True, pady=10)
-
-        self.log_text = scrolledtext.ScrolledText(log_frame, height=10, font=("Consolas", 9), state=tk.DISABLED)
-        self.log_text.pack(fill=tk.BOTH, expand=True)
+logger = logging.getLogger('register')
 
-        nickname_entry.bind('<Return>', lambda e: self.start_registration())
+# пустой или оборванный ответ сервера на регистрацию не разбирается как JSON
+REGISTRATION_ERRORS = (*RECONNECT_ERRORS, ValueError)
 
 
-    def log_message(self, message):
-        try:
-            self.log_text.config(state=tk.NORMAL)
-            timestamp = datetime.now().strftime("%H:%M:%S")
-            self.log_text.insert(tk.END, f"[{timestamp}] {message}\n")
-            self.log_text.see(tk.END)
-            self.log_text.config(state=tk.DISABLED)
-            self.root.update()
-        except tk.TclError:
-            pass
+def validate_nickname(nickname):
+    import re
+    if not nickname:
+        return "Имя пользователя не может быть пустым"
+    if len(nickname) < 3:
+        return "Имя должно содержать минимум 3 символа"
+    if len(nickname) > 20:
+        return "Имя не должно превышать 20 символов"
+    if not re.match(r'^[a-zA-Zа-яА-Я0-9\s]+$', nickname):
+        return "Имя может содержать только буквы, цифры и пробелы"
+    return None
 
 
-    def set_ui_state(self, enabled):
+async def register_account(host, port, nickname, attempts=3, initial_delay=1, timeout=15):
+    delay = initial_delay
+    for attempt in range(1, attempts + 1):
+        writer = None
         try:
-            state = tk.NORMAL if enabled else tk.DISABLED
-            self.register_button.config(state=state)
-            if enabled:
-                self.progress.stop()
-                self.registration_in_progress = False
-            else:
-                self.progress.start()
-                self.registration_in_progress = True
-        except tk.TclError:
-            pass
-
-
-    def validate_nickname(self, nickname):
-        if not nickname:
-            return "Имя пользователя не может быть пустым"
-        if len(nickname) < 3:
-            return "Имя должно содержать минимум 3 символа"
-        if len(nickname) > 20:
-            return "Имя не должно превышать 20 символов"
-        if not re.match(r'^[a-zA-Zа-яА-Я0-9\s]+$', nickname):
-            return "Имя может содержать только буквы, цифры и пробелы"
-        return None
-
-
-    def start_registration(self):
-        nickname = self.nickname_var.get().strip()
-        error = self.validate_nickname(nickname)
-        if error:
-            messagebox.showerror("Ошибка", error)
-            return
-        thread = threading.Thread(target=self.run_async_registration, args=(nickname,))
-        thread.daemon = True
-        thread.start()
-
-
-    def run_async_registration(self, nickname):
-        try:
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-            loop.run_until_complete(self.async_register_user(nickname))
-        except Exception as e:
-            self.log_message(f"✗ Ошибка при запуске регистрации: {e}")
-
-
-    async def async_register_user(self, nickname):
-        reader, writer = None, None
-        try:
-            self.root.after(0, self.set_ui_state, False)
-            self.root.after(0, self.log_message, f"Начата регистрация для пользователя: {nickname}")
-
-            host = os.environ.get('CHAT_HOST', 'minechat.dvmn.org')
-            port = int(os.environ.get('MESSAGE_CHAT_PORT', '5050'))
-            self.root.after(0, self.log_message, f"Подключаемся к серверу {host}:{port}...")
-
-            reader, writer = await open_connection(host, port)
-            self.root.after(0, self.log_message, "✓ Соединение установлено")
-            self.root.after(0, self.log_message, "Отправляем запрос на регистрацию...")
-
-            account_info = await register(reader, writer, nickname)
-            token = account_info['account_hash']
-            registered_nickname = account_info['nickname']
-
-            self.root.after(0, self.log_message, "✓ Регистрация успешна!")
-            self.root.after(0, self.log_message, f"👤 Имя пользователя: {registered_nickname}")
-            self.root.after(0, self.log_message, f"🔑 Токен: {token[:10]}...{token[-10:]}")
-
-            async with aiofiles.open('chat_account.hash', 'w', encoding='utf-8') as f:
-                await f.write(token)
-            self.root.after(0, self.log_message, "✓ Токен сохранен в файл 'chat_account.hash'")
-
-            success_text = f"✅ Регистрация успешно завершена!\n\n👤 Имя пользователя: {registered_nickname}\n🔑 Токен сохранен в файл 'chat_account.hash'\n\nТеперь вы можете запустить чат-клиент и начать общение!"
-            self.root.after(0, lambda: messagebox.showinfo("Регистрация завершена", success_text))
-
-        except Exception as e:
-            self.root.after(0, self.log_message, f"✗ Ошибка регистрации: {e}")
-            self.root.after(0, lambda: messagebox.showerror("Ошибка регистрации", f"Не удалось завершить регистрацию:\n{e}"))
+            reader, writer = await asyncio.wait_for(open_connection(host, port), timeout)
+            account_info = await asyncio.wait_for(register(reader, writer, nickname), timeout)
+            if not isinstance(account_info, dict) or not {'nickname', 'account_hash'} <= account_info.keys():
+                raise ValueError(f"сервер вернул неожиданный ответ на регистрацию: {account_info!r}")
+            return account_info
+        except REGISTRATION_ERRORS as e:
+            if attempt == attempts:
+                raise
+            logger.warning(f"🔄 {nickname}: попытка {attempt} не удалась ({e}), повтор через {delay:.1f} с")
+            await asyncio.sleep(delay * random.uniform(1, 1.5))
+            delay *= 2
         finally:
             if writer:
                 writer.close()
-                await writer.wait_closed()
-            self.root.after(0, self.set_ui_state, True)
+                with suppress(ConnectionError):
+                    await writer.wait_closed()
+
+
+async def register_accounts(host, port, nicknames, concurrency=10, attempts=3, on_result=None):
+    limiter = asyncio.Semaphore(concurrency)
+    # результаты хранятся по имени, повторное имя зарегистрировало бы второй аккаунт и затёрло первый
+    nicknames = list(dict.fromkeys(nicknames))
+    results = {}
+
+    async def register_one(nickname):
+        # одно соединение на имя, но не больше concurrency одновременно, чтобы не упереться в лимиты сервера
+        async with limiter:
+            try:
+                account_info = await register_account(host, port, nickname, attempts)
+            except Exception as e:
+                # любая ошибка - неудача только этого имени, токены остальных должны попасть в хранилище
+                logger.error(f"❌ {nickname}: не удалось зарегистрировать ({e})")
+                account_info, error = None, e
+            else:
+                account_info, error = {
+                    'nickname': account_info['nickname'], 'account_hash': account_info['account_hash'],
+                }, None
+        results[nickname] = account_info
+        if on_result:
+            on_result(nickname, account_info, error)
+
+    async with anyio.create_task_group() as registration_group:
+        for nickname in nicknames:
+            registration_group.start_soon(register_one, nickname)
+    accounts = [results[nickname] for nickname in nicknames if results[nickname]]
+    failed = [nickname for nickname in nicknames if not results[nickname]]
+    return accounts, failed
+
+
+def add_to_token_store(store_file, accounts):
+    # все новые токены попадают в хранилище одной атомарной записью
+    known_hashes = set()
+    merged = []
+    for account in [*load_token_store(store_file), *accounts]:
+        if account['account_hash'] not in known_hashes:
+            known_hashes.add(account['account_hash'])
+            merged.append(account)
+    save_token_store(store_file, merged)
+    return len(merged)
+
+
+def read_nicknames(nicknames, batch_file):
+    if batch_file == '-':
+        nicknames += sys.stdin.read().splitlines()
+    elif batch_file:
+        with open(batch_file, 'r', encoding='utf-8') as f:
+            nicknames += f.read().splitlines()
+    return list(dict.fromkeys(nickname.strip() for nickname in nicknames if nickname.strip()))
+
+
+async def register_batch(nicknames, store_file, concurrency, attempts):
+    host = os.environ.get('CHAT_HOST', 'minechat.dvmn.org')
+    port = int(os.environ.get('MESSAGE_CHAT_PORT', '5050'))
+    logger.info(f"👥 Регистрируем {len(nicknames)} пользователей на {host}:{port}, одновременно {concurrency}")
+    accounts, failed = await register_accounts(host, port, nicknames, concurrency, attempts)
+    if accounts:
+        total = await asyncio.to_thread(add_to_token_store, store_file, accounts)
+        logger.info(f"✅ Зарегистрировано {len(accounts)} из {len(nicknames)}, в {store_file} теперь {total} токенов")
+    return failed
+
+
+def run_batch(args):
+    nicknames = read_nicknames(args.nicknames, args.batch)
+    errors = [f"{nickname}: {error}" for nickname in nicknames if (error := validate_nickname(nickname))]
+    if errors:
+        sys.exit('\n'.join(f"❌ {error}" for error in errors))
+    if not nicknames:
+        sys.exit("❌ Список имён пуст")
+    failed = asyncio.run(register_batch(nicknames, args.accounts, max(1, args.concurrency), args.attempts))
+    if failed:
+        sys.exit(f"❌ Не удалось зарегистрировать: {', '.join(failed)}")
 
 
 def main():
+    import argparse
+    from dotenv import load_dotenv
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description='Регистрация аккаунтов чата, без аргументов открывается окно')
+    parser.add_argument('nicknames', nargs='*', help='зарегистрировать эти имена без окна')
+    parser.add_argument('--batch', help='файл с именами по одному в строке, - для stdin')
+    parser.add_argument('--accounts', default=os.environ.get('CHAT_ACCOUNTS', 'chat_accounts.json'),
+                        help='куда добавить токены')
+    parser.add_argument('--concurrency', type=int, default=int(os.environ.get('CHAT_REGISTER_CONCURRENCY', '10')),
+                        help='сколько регистраций идёт одновременно')
+    parser.add_argument('--attempts', type=int, default=3, help='попыток на каждое имя')
+    args = parser.parse_args()
+    if args.nicknames or args.batch:
+        run_batch(args)
+        return
+    # без аргументов открывается окно; tkinter нужен только ему, пакетный режим работает и без него
+    import tkinter as tk
+    from tkinter import ttk, messagebox, scrolledtext
+
+    class RegistrationApp:
+        def __init__(self, root):
+            self.root = root
+            self.root.title("Регистрация в чате Майнкрафтера")
+            self.root.geometry("600x700")
+            self.root.resizable(False, False)
+            self.registration_in_progress = False
+            self.loop = None
+            self.root.protocol("WM_DELETE_WINDOW", self.on_closing)
+            self.center_window()
+            self.setup_ui()
+
+
+        def center_window(self):
+            self.root.update_idletasks()
+            width = self.root.winfo_width()
+            height = self.root.winfo_height()
+            x = (self.root.winfo_screenwidth() // 2) - (width // 2)
+            y = (self.root.winfo_screenheight() // 2) - (height // 2)
+            self.root.geometry(f'{width}x{height}+{x}+{y}')
+
+
+        def on_closing(self):
+            if self.registration_in_progress:
+                if not messagebox.askokcancel("Выход", "Регистрация еще не завершена. Вы уверены, что хотите выйти?"):
+                    return
+            self.root.destroy()
+
+
+        def setup_ui(self):
+            main_frame = ttk.Frame(self.root, padding="20")
+            main_frame.pack(fill=tk.BOTH, expand=True)
+
+            title_label = ttk.Label(main_frame, text="🎮 Регистрация в чате Майнкрафтера", font=("Arial", 16, "bold"))
+            title_label.pack(pady=(0, 20))
+
+            input_frame = ttk.LabelFrame(main_frame, text="Данные для регистрации", padding="15")
+            input_frame.pack(fill=tk.X, pady=10)
+
+            ttk.Label(input_frame, text="Выберите имя пользователя:", font=("Arial", 10)).pack(anchor=tk.W)
+            self.nickname_var = tk.StringVar()
+            nickname_entry = ttk.Entry(input_frame, textvariable=self.nickname_var, font=("Arial", 12), width=40)
+            nickname_entry.pack(fill=tk.X, pady=(5, 10))
+            nickname_entry.focus()
+
+            self.register_button = ttk.Button(input_frame, text="🚀 Зарегистрироваться", command=self.start_registration)
+            self.register_button.pack(pady=15)
+
+            batch_frame = ttk.LabelFrame(main_frame, text="Пакетная регистрация", padding="15")
+            batch_frame.pack(fill=tk.X, pady=10)
+
+            ttk.Label(batch_frame, text="Имена пользователей, по одному в строке:", font=("Arial", 10)).pack(anchor=tk.W)
+            self.batch_text = scrolledtext.ScrolledText(batch_frame, height=4, font=("Arial", 10))
+            self.batch_text.pack(fill=tk.X, pady=(5, 10))
+
+            batch_controls = ttk.Frame(batch_frame)
+            batch_controls.pack(fill=tk.X)
+            ttk.Label(batch_controls, text="Одновременно:").pack(side=tk.LEFT)
+            self.concurrency_var = tk.IntVar(value=int(os.environ.get('CHAT_REGISTER_CONCURRENCY', '10')))
+            ttk.Spinbox(batch_controls, from_=1, to=100, textvariable=self.concurrency_var, width=5).pack(side=tk.LEFT, padx=5)
+            self.batch_button = ttk.Button(batch_controls, text="👥 Зарегистрировать список",
+                                           command=self.start_batch_registration)
+            self.batch_button.pack(side=tk.RIGHT)
+
+            self.progress = ttk.Progressbar(main_frame, mode='indeterminate', length=500)
+            self.progress.pack(fill=tk.X, pady=5)
+
+            log_frame = ttk.LabelFrame(main_frame, text="Журнал регистрации", padding="10")
+            log_frame.pack(fill=tk.BOTH, expand=True, pady=10)
+
+            self.log_text = scrolledtext.ScrolledText(log_frame, height=10, font=("Consolas", 9), state=tk.DISABLED)
+            self.log_text.pack(fill=tk.BOTH, expand=True)
+
+            nickname_entry.bind('<Return>', lambda e: self.start_registration())
+
+
+        def log_message(self, message):
+            try:
+                self.log_text.config(state=tk.NORMAL)
+                timestamp = datetime.now().strftime("%H:%M:%S")
+                self.log_text.insert(tk.END, f"[{timestamp}] {message}\n")
+                self.log_text.see(tk.END)
+                self.log_text.config(state=tk.DISABLED)
+                self.root.update()
+            except tk.TclError:
+                pass
+
+
+        def set_ui_state(self, enabled):
+            try:
+                state = tk.NORMAL if enabled else tk.DISABLED
+                self.register_button.config(state=state)
+                self.batch_button.config(state=state)
+                if enabled:
+                    self.progress.stop()
+                    self.registration_in_progress = False
+                else:
+                    self.progress.start()
+                    self.registration_in_progress = True
+            except tk.TclError:
+                pass
+
+
+        def run_in_background(self, coroutine):
+            # один цикл событий в фоновом потоке на всё время работы окна, а не новый на каждое нажатие
+            if self.loop is None:
+                import threading
+                self.loop = asyncio.new_event_loop()
+                threading.Thread(target=self.loop.run_forever, daemon=True).start()
+            future = asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+            future.add_done_callback(self.report_background_error)
+
+
+        def report_background_error(self, future):
+            if not future.cancelled() and future.exception():
+                self.root.after(0, self.log_message, f"✗ Ошибка при запуске регистрации: {future.exception()}")
+
+
+        def start_registration(self):
+            nickname = self.nickname_var.get().strip()
+            error = validate_nickname(nickname)
+            if error:
+                messagebox.showerror("Ошибка", error)
+                return
+            self.run_in_background(self.async_register_user(nickname))
+
+
+        def start_batch_registration(self):
+            nicknames = list(dict.fromkeys(line.strip() for line in self.batch_text.get('1.0', tk.END).splitlines()))
+            nicknames = [nickname for nickname in nicknames if nickname]
+            if not nicknames:
+                messagebox.showerror("Ошибка", "Список имён пуст")
+                return
+            for nickname in nicknames:
+                error = validate_nickname(nickname)
+                if error:
+                    messagebox.showerror("Ошибка", f"{nickname}: {error}")
+                    return
+            try:
+                concurrency = max(1, self.concurrency_var.get())
+            except tk.TclError:
+                messagebox.showerror("Ошибка", "Число одновременных регистраций должно быть целым")
+                return
+            self.run_in_background(self.async_register_batch(nicknames, concurrency))
+
+
+        async def async_register_user(self, nickname):
+            try:
+                self.root.after(0, self.set_ui_state, False)
+                self.root.after(0, self.log_message, f"Начата регистрация для пользователя: {nickname}")
+
+                host = os.environ.get('CHAT_HOST', 'minechat.dvmn.org')
+                port = int(os.environ.get('MESSAGE_CHAT_PORT', '5050'))
+                self.root.after(0, self.log_message, f"Подключаемся к серверу {host}:{port}...")
+
+                account_info = await register_account(host, port, nickname)
+                token = account_info['account_hash']
+                registered_nickname = account_info['nickname']
+
+                self.root.after(0, self.log_message, "✓ Регистрация успешна!")
+                self.root.after(0, self.log_message, f"👤 Имя пользователя: {registered_nickname}")
+                self.root.after(0, self.log_message, f"🔑 Токен: {token[:10]}...{token[-10:]}")
+
+                import aiofiles
+                async with aiofiles.open('chat_account.hash', 'w', encoding='utf-8') as f:
+                    await f.write(token)
+                self.root.after(0, self.log_message, "✓ Токен сохранен в файл 'chat_account.hash'")
+
+                success_text = f"✅ Регистрация успешно завершена!\n\n👤 Имя пользователя: {registered_nickname}\n🔑 Токен сохранен в файл 'chat_account.hash'\n\nТеперь вы можете запустить чат-клиент и начать общение!"
+                self.root.after(0, lambda: messagebox.showinfo("Регистрация завершена", success_text))
+
+            except Exception as e:
+                error_text = f"Не удалось завершить регистрацию:\n{e}"
+                self.root.after(0, self.log_message, f"✗ Ошибка регистрации: {e}")
+                self.root.after(0, lambda: messagebox.showerror("Ошибка регистрации", error_text))
+            finally:
+                self.root.after(0, self.set_ui_state, True)
+
+
+        async def async_register_batch(self, nicknames, concurrency):
+            store_file = os.environ.get('CHAT_ACCOUNTS', 'chat_accounts.json')
+            try:
+                self.root.after(0, self.set_ui_state, False)
+                self.root.after(0, self.log_message, f"Начата регистрация {len(nicknames)} пользователей, "
+                                                     f"одновременно {concurrency}")
+
+                def on_result(nickname, account_info, error):
+                    if account_info:
+                        self.root.after(0, self.log_message, f"✓ {nickname}: зарегистрирован как {account_info['nickname']}")
+                    else:
+                        self.root.after(0, self.log_message, f"✗ {nickname}: {error}")
+
+                host = os.environ.get('CHAT_HOST', 'minechat.dvmn.org')
+                port = int(os.environ.get('MESSAGE_CHAT_PORT', '5050'))
+                accounts, failed = await register_accounts(host, port, nicknames, concurrency, on_result=on_result)
+                if accounts:
+                    await asyncio.to_thread(add_to_token_store, store_file, accounts)
+                    self.root.after(0, self.log_message, f"✓ Токены сохранены в файл '{store_file}'")
+
+                result_text = f"Зарегистрировано: {len(accounts)} из {len(nicknames)}\nТокены сохранены в файл '{store_file}'"
+                if failed:
+                    result_text += f"\n\nНе удалось зарегистрировать: {', '.join(failed)}"
+                self.root.after(0, lambda: messagebox.showinfo("Пакетная регистрация завершена", result_text))
+            except Exception as e:
+                error_text = f"Не удалось сохранить токены:\n{e}"
+                self.root.after(0, self.log_message, f"✗ Ошибка пакетной регистрации: {e}")
+                self.root.after(0, lambda: messagebox.showerror("Ошибка регистрации", error_text))
+            finally:
+                self.root.after(0, self.set_ui_state, True)
+
     try:
         root = tk.Tk()
         app = RegistrationApp(root)
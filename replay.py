@@ -0,0 +1,172 @@
+import argparse
+import asyncio
+import logging
+import os
+import tempfile
+import time
+from collections import deque
+
+import capture
+from bus import CHAT_TOPIC, SYSTEM_TOPIC, MessageBus
+from chat_prototype import (READ_ENGINES, Heartbeat, prepare_environment, replay_filter_from_env, save_messages,
+                            stop_saving)
+from history import HISTORY_BACKENDS, open_history
+from queues import queue_from_env
+
+
+logger = logging.getLogger('replay')
+
+WRITE_BUFFER_LIMIT = 1024 * 1024
+
+
+def read_records(capture_file, connection_id=None):
+    # записи каждого соединения для чтения отдельно и в исходном порядке: после переподключения
+    # сервер повторяет последние сообщения, и клиент должен увидеть этот повтор в начале нового соединения
+    connections = {}
+    for offset, channel, record_connection_id, data in capture.read_capture(capture_file):
+        if channel == capture.READ and connection_id in (None, record_connection_id):
+            connections.setdefault(record_connection_id, []).append((offset, data))
+    connections = list(connections.values())
+    if not connections:
+        return connections, 0, 0
+    duration = connections[-1][-1][0] - connections[0][0][0]
+    lines = sum(data.count(b'\n') for records in connections for _, data in records)
+    return connections, lines, duration
+
+
+async def play_records(records, writer, speed):
+    # отдаём записанные байты клиенту так же, как их отдавал сервер: с исходными паузами,
+    # в speed раз быстрее или, при speed=0, без пауз
+    first_offset = records[0][0] if records else 0
+    started_at = time.monotonic()
+    for offset, data in records:
+        if speed:
+            delay = started_at + (offset - first_offset) / speed - time.monotonic()
+            if delay > 0:
+                await writer.drain()
+                await asyncio.sleep(delay)
+        writer.write(data)
+        if writer.transport.get_write_buffer_size() > WRITE_BUFFER_LIMIT:
+            await writer.drain()
+    await writer.drain()
+    writer.close()
+
+
+async def discard_messages(messages_queue):
+    while True:
+        await messages_queue.get()
+
+
+async def wait_for_empty(queue):
+    while not queue.empty():
+        await asyncio.sleep(0.01)
+
+
+async def replay(connections, speed, read_engine, history, show_gui):
+    pending_connections = deque(connections)
+
+    async def handle_reader(reader, writer):
+        await play_records(pending_connections.popleft(), writer, speed)
+
+    server = await asyncio.start_server(handle_reader, '127.0.0.1', 0)
+    host, port = server.sockets[0].getsockname()[:2]
+
+    messages_queue = queue_from_env('messages', 10000, 'drop_oldest')
+    save_queue = queue_from_env('save', 10000, 'block')
+    bus = MessageBus()
+    bus.subscribe(messages_queue, CHAT_TOPIC)
+    bus.subscribe(save_queue, CHAT_TOPIC, SYSTEM_TOPIC)
+
+    root = None
+    if show_gui:
+        import tkinter as tk
+        from tkinter.scrolledtext import ScrolledText
+        from gui import update_conversation_history, update_tk
+        try:
+            root = tk.Tk()
+        except tk.TclError as e:
+            raise SystemExit(f"❌ Не удалось открыть окно ({e}), запустите с --no-gui")
+        panel = ScrolledText(root, wrap='none')
+        panel.pack(fill='both', expand=True)
+        consumers = [
+            asyncio.create_task(update_tk(root)),
+            asyncio.create_task(update_conversation_history(panel, messages_queue)),
+        ]
+    else:
+        consumers = [asyncio.create_task(discard_messages(messages_queue))]
+    save_task = asyncio.create_task(save_messages(history, save_queue))
+    # как у живого клиента: повтор после переподключения отсеивается, а не попадает в окно и историю второй раз
+    replay_filter = await replay_filter_from_env(history)
+
+    started_at = time.monotonic()
+    for _ in connections:
+        try:
+            await read_engine(host, port, bus, asyncio.Queue(), Heartbeat(), replay_filter)
+        except ConnectionError:
+            # записи соединения кончились, сервер воспроизведения закрыл его - подключаемся к следующему
+            pass
+    await wait_for_empty(messages_queue)
+    await stop_saving(save_task, save_queue)
+    elapsed = time.monotonic() - started_at
+
+    for task in consumers:
+        task.cancel()
+    await asyncio.gather(*consumers, return_exceptions=True)
+    if root:
+        root.destroy()
+    server.close()
+    await server.wait_closed()
+    return elapsed
+
+
+def dump_capture(capture_file):
+    for offset, channel, connection_id, data in capture.read_capture(capture_file):
+        print(f"{offset:12.6f} {capture.CHANNEL_NAMES.get(channel, channel):5} #{connection_id:<4} {data!r}")
+
+
+def main():
+    prepare_environment()
+    parser = argparse.ArgumentParser(description='Воспроизведение записанного трафика чата через клиент')
+    parser.add_argument('capture', help='файл, записанный с CHAT_CAPTURE')
+    parser.add_argument('--speed', type=float, default=1,
+                        help='во сколько раз быстрее записи, 0 - без пауз, насколько хватит клиента')
+    parser.add_argument('--engine', choices=READ_ENGINES, default=os.environ.get('CHAT_READ_ENGINE', 'stream'))
+    parser.add_argument('--history', help='куда писать историю, по умолчанию во временный файл')
+    parser.add_argument('--history-backend', choices=HISTORY_BACKENDS,
+                        default=os.environ.get('CHAT_HISTORY_BACKEND', 'text'))
+    parser.add_argument('--no-gui', action='store_true', help='не открывать окно, только чтение и история')
+    parser.add_argument('--profile', help='снять профиль cProfile в этот файл')
+    parser.add_argument('--profile-top', type=int, default=25, help='сколько самых дорогих функций показать')
+    parser.add_argument('--connection', type=int, help='воспроизвести только соединение с этим номером из --dump')
+    parser.add_argument('--dump', action='store_true', help='вывести записи файла и выйти')
+    args = parser.parse_args()
+
+    if args.dump:
+        dump_capture(args.capture)
+        return
+
+    connections, lines, duration = read_records(args.capture, args.connection)
+    if not connections:
+        raise SystemExit(f"❌ В {args.capture} нет записей чтения" +
+                         (f" соединения #{args.connection}" if args.connection is not None else ""))
+    logger.info(
+        f"▶️ {args.capture}: {lines} строк в {len(connections)} соединениях за {duration:.1f} с, "
+        f"скорость {args.speed or 'максимальная'}"
+    )
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        history = open_history(args.history_backend, args.history or os.path.join(tmp_dir, 'chat_history'))
+        coroutine = replay(connections, args.speed, READ_ENGINES[args.engine], history, not args.no_gui)
+        if args.profile:
+            import cProfile
+            import pstats
+            profiler = cProfile.Profile()
+            elapsed = profiler.runcall(asyncio.run, coroutine)
+            profiler.dump_stats(args.profile)
+            pstats.Stats(profiler).sort_stats('tottime').print_stats(args.profile_top)
+        else:
+            elapsed = asyncio.run(coroutine)
+    print(f"воспроизведено {lines} строк за {elapsed:.2f} с ({lines / elapsed:,.0f} строк/с), в записи {duration:.2f} с")
+
+
+if __name__ == '__main__':
+    main()
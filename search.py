@@ -0,0 +1,182 @@
+import asyncio
+import datetime
+import logging
+import os
+import sys
+from contextlib import closing
+
+from chat_message import SYSTEM, ChatMessage
+
+
+logger = logging.getLogger('search')
+
+REBUILD_BATCH_SIZE = 10000
+DATE_FORMAT = '%Y-%m-%d'
+FILTER_PREFIXES = {
+    'from:': 'author',
+    'after:': 'since',
+    'before:': 'until',
+}
+
+
+def parse_query(query):
+    terms = []
+    filters = {}
+    for word in query.split():
+        for prefix, name in FILTER_PREFIXES.items():
+            if word.startswith(prefix) and len(word) > len(prefix):
+                filters[name] = word[len(prefix):]
+                break
+        else:
+            is_prefix = word.endswith('*')
+            word = word.rstrip('*').replace('"', '""')
+            if word:
+                terms.append(f'"{word}"*' if is_prefix else f'"{word}"')
+    for name in ('since', 'until'):
+        if name in filters:
+            try:
+                filters[name] = datetime.datetime.strptime(filters[name], DATE_FORMAT)
+            except ValueError:
+                raise ValueError(f"Дата должна быть в формате ГГГГ-ММ-ДД: {filters[name]}")
+    if 'until' in filters:
+        # before:2025-10-04 включает весь этот день
+        filters['until'] += datetime.timedelta(days=1)
+    return ' '.join(terms), filters
+
+
+def stored_position(position):
+    # в индексе храним только устойчивые места: смещение в текстовой истории и id в SQLite;
+    # курсор текущего файла ротируемой истории меняет смысл после ротации, по нему не переходим
+    return position if isinstance(position, int) else None
+
+
+class SearchIndex:
+    def __init__(self, index_file):
+        self.index_file = index_file
+        self.connection = None
+
+    def connect(self):
+        import sqlite3
+        connection = sqlite3.connect(self.index_file, check_same_thread=False)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        connection.execute(
+            'CREATE VIRTUAL TABLE IF NOT EXISTS messages USING fts5('
+            'text, author, created_at UNINDEXED, direction UNINDEXED, position UNINDEXED, '
+            "tokenize='unicode61 remove_diacritics 2')"
+        )
+        return connection
+
+    async def __aenter__(self):
+        self.connection = await asyncio.to_thread(self.connect)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await asyncio.to_thread(self.disconnect)
+
+    def disconnect(self):
+        self.connection.commit()
+        self.connection.close()
+        self.connection = None
+
+    def insert(self, connection, messages):
+        connection.executemany(
+            'INSERT INTO messages (text, author, created_at, direction, position) VALUES (?, ?, ?, ?, ?)',
+            [
+                (message.text, message.author or '', message.received_at, message.direction,
+                 stored_position(message.history_position))
+                for message in messages if message.direction != SYSTEM
+            ],
+        )
+
+    async def add(self, messages):
+        await asyncio.to_thread(self.insert, self.connection, messages)
+
+    async def flush(self):
+        await asyncio.to_thread(self.connection.commit)
+
+    def search(self, query, limit=50):
+        match, filters = parse_query(query)
+        conditions = []
+        params = []
+        if match:
+            conditions.append('messages MATCH ?')
+            params.append(match)
+        if 'author' in filters:
+            conditions.append('author = ?')
+            params.append(filters['author'])
+        if 'since' in filters:
+            conditions.append('created_at >= ?')
+            params.append(filters['since'].timestamp())
+        if 'until' in filters:
+            conditions.append('created_at < ?')
+            params.append(filters['until'].timestamp())
+        if not conditions:
+            return []
+
+        order = 'rank, created_at DESC' if match else 'created_at DESC'
+        with closing(self.connect()) as connection:
+            rows = connection.execute(
+                f"SELECT text, created_at, direction, position FROM messages WHERE {' AND '.join(conditions)} "
+                f"ORDER BY {order} LIMIT ?",
+                (*params, limit),
+            ).fetchall()
+        messages = []
+        for text, created_at, direction, position in rows:
+            message = ChatMessage.stored(direction, text, created_at)
+            message.history_position = position
+            messages.append(message)
+        return messages
+
+    def rebuild(self, history):
+        indexed = 0
+        with closing(self.connect()) as connection:
+            connection.execute('DELETE FROM messages')
+            # идём от конца истории к началу, как окно чата: так у каждой строки есть её место в истории,
+            # а отсутствующий файл истории - просто пустая история
+            entries, positions, cursor = history.read_page(None, REBUILD_BATCH_SIZE)
+            while entries:
+                self.insert(connection, [
+                    ChatMessage.from_history(timestamp, line, position)
+                    for (timestamp, line), position in zip(entries, positions)
+                ])
+                indexed += len(entries)
+                if cursor is None:
+                    break
+                entries, positions, cursor = history.read_page(cursor, REBUILD_BATCH_SIZE)
+            connection.execute("INSERT INTO messages (messages) VALUES ('optimize')")
+            connection.commit()
+        logger.info(f"🔎 Проиндексировано {indexed} сообщений из {history.history_file}")
+        return indexed
+
+
+def main():
+    import argparse
+    from chat_prototype import history_from_env, prepare_environment
+
+    prepare_environment()
+    parser = argparse.ArgumentParser(description='Поиск по истории чата')
+    parser.add_argument('--index', default=os.environ.get('CHAT_SEARCH_INDEX', 'chat_search.sqlite3'))
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('rebuild', help='заново построить индекс по всей истории из CHAT_HISTORY')
+    query_parser = subparsers.add_parser('query', help='найти сообщения')
+    query_parser.add_argument('query', nargs='+', help='слова, слово* для префикса, from:ник, after:/before:ГГГГ-ММ-ДД')
+    query_parser.add_argument('--limit', type=int, default=50)
+    args = parser.parse_args()
+
+    search_index = SearchIndex(args.index)
+    if args.command == 'rebuild':
+        history, _, _ = history_from_env()
+        search_index.rebuild(history)
+    elif args.command == 'query':
+        try:
+            messages = search_index.search(' '.join(args.query), args.limit)
+        except ValueError as e:
+            sys.exit(f"❌ {e}")
+        for message in messages:
+            stamp = f"{message.timestamp:%d.%m.%y %H:%M} " if message.timestamp else ''
+            print(f"{stamp}{message.line}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,20 @@
+import json
+import os
+
+
+def load_token_store(store_file):
+    if not os.path.exists(store_file):
+        return []
+    with open(store_file, 'r', encoding='utf-8') as f:
+        accounts = json.load(f)
+    return [account for account in accounts if account.get('account_hash')]
+
+
+def save_token_store(store_file, accounts):
+    # пишем во временный файл и подменяем им хранилище, чтобы не потерять токены при сбое
+    temp_file = f'{store_file}.tmp'
+    with open(temp_file, 'w', encoding='utf-8') as f:
+        json.dump(accounts, f, ensure_ascii=False, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_file, store_file)